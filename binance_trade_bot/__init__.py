@@ -1,3 +1,4 @@
 from .backtest import backtest
 from .binance_api_manager import BinanceAPIManager
 from .crypto_trading import main as run_trader
+from .sweep import sweep
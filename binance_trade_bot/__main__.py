@@ -1,7 +1,20 @@
-from .crypto_trading import main
+import argparse
+
+from .crypto_trading import main, run_bots
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the trading bot")
+    parser.add_argument(
+        "--bots",
+        nargs="+",
+        metavar="DIR",
+        help="run one bot per directory, each with its own user.cfg and supported_coin_list",
+    )
+    args = parser.parse_args()
     try:
-        main()
+        if args.bots:
+            run_bots(args.bots)
+        else:
+            main()
     except KeyboardInterrupt:
         pass
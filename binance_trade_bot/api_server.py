@@ -1,18 +1,24 @@
+import base64
+import binascii
+import hmac
+import json
 import re
 from datetime import datetime, timedelta
-from itertools import groupby
-from typing import List, Tuple
+from itertools import groupby, islice
+from typing import Callable, Iterator, List, Optional, Tuple
 
-from flask import Flask, jsonify, request
+from flask import Flask, Response, abort, jsonify, request, url_for
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
-from sqlalchemy import func
-from sqlalchemy.orm import Session
+from sqlalchemy import DateTime, Integer, cast, func, tuple_
+from sqlalchemy.orm import Query, Session, contains_eager
 
 from .config import Config
-from .database import Database
+from .database import Database, if_dialect
+from .instrumentation import instrumentation as local_instrumentation
+from .instrumentation import prometheus_text
 from .logger import Logger
-from .models import Coin, CoinValue, CurrentCoin, Pair, ScoutHistory, Trade
+from .models import Coin, CoinValue, CurrentCoin, Interval, Pair, PortfolioValue, ScoutHistory, Trade
 
 app = Flask(__name__)
 cors = CORS(app, resources={r"/api/*": {"origins": "*"}})
@@ -24,6 +30,22 @@ config = Config()
 logger = Logger(config, "api_server")
 db = Database(logger, config)
 
+# Latest metrics sent by the bot, see Database.send_instrumentation. Those of this process aren't served, so
+# don't record them.
+latest_instrumentation = {}
+local_instrumentation.enabled = False
+
+# Rows read from the database and serialized at a time by streamed responses
+STREAM_CHUNK_SIZE = 1000
+
+# Seconds between two coin values of each tier, see Database.prune_value_history
+INTERVAL_SECONDS = {
+    Interval.MINUTELY: 60,
+    Interval.HOURLY: 60 * 60,
+    Interval.DAILY: 24 * 60 * 60,
+    Interval.WEEKLY: 7 * 24 * 60 * 60,
+}
+
 
 def filter_period(query, model):  # pylint: disable=inconsistent-return-statements
     period = request.args.get("period", "all")
@@ -45,34 +67,156 @@ def filter_period(query, model):  # pylint: disable=inconsistent-return-statemen
         return query.filter(model.datetime >= datetime.now() - timedelta(days=28 * num))
 
 
+def encode_cursor(key: tuple) -> str:
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in key]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor: str, keys: tuple) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        if not isinstance(values, list) or len(values) != len(keys):
+            raise ValueError(cursor)
+        return [
+            datetime.fromisoformat(value) if isinstance(key.type, DateTime) else value
+            for key, value in zip(keys, values)
+        ]
+    except (binascii.Error, TypeError, ValueError):
+        return abort(400, description=f"Invalid cursor {cursor}")
+
+
+def paginate(query: Query, keys: tuple) -> Tuple[Query, Optional[str]]:  # pylint: disable=unsubscriptable-object
+    """
+    Restrict a query ordered by `keys` to the page given by the `after` and `limit` arguments of the request.
+    Returns the query of the page and the cursor of the next one, None on the last page.
+    """
+    after = request.args.get("after")
+    if after:
+        query = query.filter(tuple_(*keys) > tuple_(*decode_cursor(after, keys)))
+
+    limit = request.args.get("limit", type=int)
+    if not limit or limit < 0:
+        return query, None
+
+    # Keys of the last row of the page and of the row after it, if any
+    last_keys = query.enable_eagerloads(False).with_entities(*keys).offset(limit - 1).limit(2).all()
+    return query.limit(limit), encode_cursor(tuple(last_keys[0])) if len(last_keys) == 2 else None
+
+
+def json_list(rows: Iterator) -> Iterator[str]:
+    separator = "["
+    while True:
+        chunk = list(islice(rows, STREAM_CHUNK_SIZE))
+        if not chunk:
+            break
+        yield separator + ",".join(json.dumps(row.info(), separators=(",", ":"), sort_keys=True) for row in chunk)
+        separator = ","
+    yield "[]" if separator == "[" else "]"
+
+
+def json_coin_values(coin_values: Iterator[CoinValue]) -> Iterator[str]:
+    separator = "{"
+    for coin_id, history in groupby(coin_values, key=lambda cv: cv.coin_id):
+        yield f"{separator}{json.dumps(coin_id)}:"
+        yield from json_list(history)
+        separator = ","
+    yield "{}" if separator == "{" else "}"
+
+
+def stream_json(
+    build_query: Callable[[Session], Query], keys: tuple, serialize: Callable[[Iterator], Iterator[str]] = json_list
+) -> Response:
+    """
+    Stream the rows of a query as json, reading them STREAM_CHUNK_SIZE at a time so that memory stays flat
+    however long the history is. The query is paginated on `keys` (see paginate), with a Link header pointing
+    to the next page.
+    """
+
+    def generate():
+        session: Session
+        with db.db_session() as session:
+            query, next_cursor = paginate(build_query(session).order_by(*keys), keys)
+            yield next_cursor
+            yield from serialize(iter(query.yield_per(STREAM_CHUNK_SIZE)))
+
+    chunks = generate()
+    next_cursor = next(chunks)
+    response = Response(chunks, mimetype="application/json")
+    if next_cursor is not None:
+        next_url = url_for(request.endpoint, **request.view_args, **{**request.args.to_dict(), "after": next_cursor})
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
+
+
+def downsample_values(query: Query, model, sample, *group_by) -> Query:
+    """
+    Restrict a query of coin or portfolio values to the resolution given by the `resolution` and `max_points`
+    arguments of the request, the `group_by` columns telling the series apart.
+
+    `resolution` picks a tier of the value history. Values of coarser tiers are promoted from finer ones, so a tier is
+    read along with the coarser ones. `max_points` picks the coarsest tier having at least that many points over
+    the period, then keeps the value with the lowest `sample` of every bucket of period / max_points, the same
+    way the tiers keep the first value of every hour, day or week.
+    """
+    resolution = request.args.get("resolution")
+    max_points = request.args.get("max_points", type=int)
+    if resolution is None and not max_points:
+        return query
+
+    tier = None
+    if resolution is not None:
+        try:
+            tier = Interval[resolution.upper()]
+        except KeyError:
+            abort(400, description=f"Invalid resolution {resolution}")
+
+    bucket_seconds = 0
+    if max_points and max_points > 0:
+        first, last = query.with_entities(func.min(model.datetime), func.max(model.datetime)).one()
+        if first is not None:
+            bucket_seconds = int((last - first).total_seconds() / max_points)
+    if tier is None:
+        tier = max(
+            (interval for interval, seconds in INTERVAL_SECONDS.items() if seconds <= bucket_seconds),
+            key=INTERVAL_SECONDS.get,
+            default=Interval.MINUTELY,
+        )
+
+    tiers = [interval for interval, seconds in INTERVAL_SECONDS.items() if seconds >= INTERVAL_SECONDS[tier]]
+    query = query.filter(model.interval.in_(tiers))
+    if bucket_seconds <= INTERVAL_SECONDS[tier]:
+        return query
+
+    epoch = if_dialect(
+        default=func.extract("epoch", model.datetime),
+        sqlite=func.strftime("%s", model.datetime),
+    )
+    bucket = cast(epoch, Integer) / bucket_seconds
+    samples = query.with_entities(func.min(sample)).group_by(*group_by, bucket)
+    return query.filter(sample.in_(samples.statement.correlate(None)))
+
+
 @app.route("/api/value_history/<coin>")
 @app.route("/api/value_history")
 def value_history(coin: str = None):
-    session: Session
-    with db.db_session() as session:
-        query = session.query(CoinValue).order_by(CoinValue.coin_id.asc(), CoinValue.datetime.asc())
-
-        query = filter_period(query, CoinValue)
-
+    def build_query(session: Session):
+        query = filter_period(session.query(CoinValue), CoinValue)
         if coin:
-            values: List[CoinValue] = query.filter(CoinValue.coin_id == coin).all()
-            return jsonify([entry.info() for entry in values])
+            query = query.filter(CoinValue.coin_id == coin)
+        return downsample_values(query, CoinValue, CoinValue.id, CoinValue.coin_id)
 
-        coin_values = groupby(query.all(), key=lambda cv: cv.coin)
-        return jsonify({coin.symbol: [entry.info() for entry in history] for coin, history in coin_values})
+    if coin:
+        return stream_json(build_query, (CoinValue.datetime, CoinValue.id))
+    return stream_json(build_query, (CoinValue.coin_id, CoinValue.datetime, CoinValue.id), json_coin_values)
 
 
 @app.route("/api/total_value_history")
 def total_value_history():
     session: Session
     with db.db_session() as session:
-        query = session.query(
-            CoinValue.datetime,
-            func.sum(CoinValue.btc_value),
-            func.sum(CoinValue.usd_value),
-        ).group_by(CoinValue.datetime)
-
-        query = filter_period(query, CoinValue)
+        query = filter_period(session.query(PortfolioValue), PortfolioValue)
+        query = downsample_values(query, PortfolioValue, PortfolioValue.id).order_by(PortfolioValue.datetime)
+        query = query.with_entities(PortfolioValue.datetime, PortfolioValue.btc_value, PortfolioValue.usd_value)
 
         total_values: List[Tuple[datetime, float, float]] = query.all()
         return jsonify([{"datetime": tv[0], "btc": tv[1], "usd": tv[2]} for tv in total_values])
@@ -80,33 +224,24 @@ def total_value_history():
 
 @app.route("/api/trade_history")
 def trade_history():
-    session: Session
-    with db.db_session() as session:
-        query = session.query(Trade).order_by(Trade.datetime.asc())
-
-        query = filter_period(query, Trade)
-
-        trades: List[Trade] = query.all()
-        return jsonify([trade.info() for trade in trades])
+    return stream_json(lambda session: filter_period(session.query(Trade), Trade), (Trade.datetime, Trade.id))
 
 
 @app.route("/api/scouting_history")
 def scouting_history():
     _current_coin = db.get_current_coin()
     coin = _current_coin.symbol if _current_coin is not None else None
-    session: Session
-    with db.db_session() as session:
+
+    def build_query(session: Session):
         query = (
             session.query(ScoutHistory)
             .join(ScoutHistory.pair)
+            .options(contains_eager(ScoutHistory.pair))
             .filter(Pair.from_coin_id == coin)
-            .order_by(ScoutHistory.datetime.asc())
         )
+        return filter_period(query, ScoutHistory)
 
-        query = filter_period(query, ScoutHistory)
-
-        scouts: List[ScoutHistory] = query.all()
-        return jsonify([scout.info() for scout in scouts])
+    return stream_json(build_query, (ScoutHistory.datetime, ScoutHistory.id))
 
 
 @app.route("/api/current_coin")
@@ -144,10 +279,38 @@ def pairs():
         return jsonify([pair.info() for pair in all_pairs])
 
 
+@app.route("/api/instrumentation")
+def instrumentation():
+    return jsonify(latest_instrumentation)
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(prometheus_text(latest_instrumentation), mimetype="text/plain; version=0.0.4")
+
+
+# Kept out of /api/, which allows any origin, since profiling slows the bot down
+@app.route("/profile", methods=["POST"])
+def profile():
+    if not config.PROFILE_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("X-Profile-Token", ""), config.PROFILE_TOKEN):
+        abort(403)
+    ticks = request.args.get("ticks", 100, type=int)
+    socketio.emit("profile", {"ticks": ticks}, namespace="/backend")
+    return jsonify({"ticks": ticks})
+
+
 @socketio.on("update", namespace="/backend")
 def handle_my_custom_event(json):
     emit("update", json, namespace="/frontend", broadcast=True)
 
 
+@socketio.on("instrumentation", namespace="/backend")
+def handle_instrumentation(json):
+    latest_instrumentation.clear()
+    latest_instrumentation.update(json)
+
+
 if __name__ == "__main__":
     socketio.run(app, debug=True, port=5123)
@@ -1,13 +1,17 @@
 from datetime import datetime, timedelta
 from typing import Dict, List
 
+import numpy as np
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 
 from .binance_api_manager import BinanceAPIManager
 from .config import Config
 from .database import Database
+from .instrumentation import timed
 from .logger import Logger
-from .models import Coin, CoinValue, Pair
+from .models import Coin, CoinValue, Interval, Pair, PortfolioValue
+from .ratio_engine import RatioEngine
 
 
 class AutoTrader:
@@ -16,6 +20,7 @@ class AutoTrader:
         self.db = database
         self.logger = logger
         self.config = config
+        self.ratio_engine = RatioEngine(binance_manager, database, logger, config)
 
     def initialize(self):
         self.initialize_trade_thresholds()
@@ -79,49 +84,51 @@ class AutoTrader:
             self.logger.info("Skipping update... current coin {} not found".format(coin + self.config.BRIDGE))
             return
 
-        session: Session
-        with self.db.db_session() as session:
-            inverse_pair = session.query(Pair).filter((Pair.from_coin == newPair.to_coin) & (Pair.to_coin == newPair.from_coin)).one()
-            to_price = self.manager.get_ticker_price(inverse_pair.to_coin + self.config.BRIDGE)
-            inverse_pair.ratio = coin_price / to_price
+        inverse_pair = self.db.get_pair(newPair.to_coin, newPair.from_coin)
+        to_price = self.manager.get_ticker_price(inverse_pair.to_coin + self.config.BRIDGE)
+        inverse_pair.ratio = coin_price / to_price
+        updated_pairs = [inverse_pair]
 
-            for pair in session.query(Pair).filter(Pair.to_coin == coin):
-                from_coin_price = self.manager.get_ticker_price(pair.from_coin + self.config.BRIDGE)
+        for pair in self.db.get_pairs_to(coin, only_enabled=False):
+            from_coin_price = self.manager.get_ticker_price(pair.from_coin + self.config.BRIDGE)
 
-                if from_coin_price is None:
-                    self.logger.info(
-                        "Skipping update for coin {} not found".format(pair.from_coin + self.config.BRIDGE)
-                    )
-                    continue
+            if from_coin_price is None:
+                self.logger.info("Skipping update for coin {} not found".format(pair.from_coin + self.config.BRIDGE))
+                continue
 
-                pair.ratio = from_coin_price / coin_price
+            pair.ratio = from_coin_price / coin_price
+            updated_pairs.append(pair)
+
+        self.db.set_ratios(updated_pairs)
+        self.ratio_engine.invalidate()
 
     def initialize_trade_thresholds(self):
         """
         Initialize the buying threshold of all the coins for trading between them
         """
-        session: Session
-        with self.db.db_session() as session:
-            for pair in session.query(Pair).filter(Pair.ratio.is_(None)).all():
-                if not pair.from_coin.enabled or not pair.to_coin.enabled:
-                    continue
-                self.logger.debug(f"Initializing {pair.from_coin} vs {pair.to_coin}")
+        updated_pairs = []
+        for pair in self.db.get_pairs(only_enabled=False):
+            if pair.ratio is not None or not pair.enabled:
+                continue
+            self.logger.debug(f"Initializing {pair.from_coin} vs {pair.to_coin}")
 
-                from_coin_price = self.manager.get_ticker_price(pair.from_coin + self.config.BRIDGE)
-                if from_coin_price is None:
-                    self.logger.info(
-                        "Skipping initializing {}, symbol not found".format(pair.from_coin + self.config.BRIDGE)
-                    )
-                    continue
+            from_coin_price = self.manager.get_ticker_price(pair.from_coin + self.config.BRIDGE)
+            if from_coin_price is None:
+                self.logger.info(
+                    "Skipping initializing {}, symbol not found".format(pair.from_coin + self.config.BRIDGE)
+                )
+                continue
 
-                to_coin_price = self.manager.get_ticker_price(pair.to_coin + self.config.BRIDGE)
-                if to_coin_price is None:
-                    self.logger.info(
-                        "Skipping initializing {}, symbol not found".format(pair.to_coin + self.config.BRIDGE)
-                    )
-                    continue
+            to_coin_price = self.manager.get_ticker_price(pair.to_coin + self.config.BRIDGE)
+            if to_coin_price is None:
+                self.logger.info("Skipping initializing {}, symbol not found".format(pair.to_coin + self.config.BRIDGE))
+                continue
+
+            pair.ratio = from_coin_price / to_coin_price
+            updated_pairs.append(pair)
 
-                pair.ratio = from_coin_price / to_coin_price
+        self.db.set_ratios(updated_pairs)
+        self.ratio_engine.invalidate()
 
     def scout(self):
         """
@@ -129,62 +136,44 @@ class AutoTrader:
         """
         raise NotImplementedError()
 
+    @timed()
     def _get_ratios(self, coin: Coin, coin_price):
         """
         Given a coin, get the current price ratio for every other enabled coin
         """
-        ratio_dict: Dict[Pair, float] = {}
-
-        for pair in self.db.get_pairs_from(coin):
-            optional_coin_price = self.manager.get_ticker_price(pair.to_coin + self.config.BRIDGE)
-
-            if optional_coin_price is None:
-                self.logger.info(
-                    "Skipping scouting... optional coin {} not found".format(pair.to_coin + self.config.BRIDGE)
-                )
-                continue
-
-            self.db.log_scout(pair, pair.ratio, coin_price, optional_coin_price)
-
-            # Obtain (current coin)/(optional coin)
-            coin_opt_coin_ratio = coin_price / optional_coin_price
-
-            transaction_fee = self.manager.get_fee(pair.from_coin, self.config.BRIDGE, True) + self.manager.get_fee(
-                pair.to_coin, self.config.BRIDGE, False
-            )
-
-            ratio_dict[pair] = (
-                coin_opt_coin_ratio - transaction_fee * self.config.SCOUT_MULTIPLIER * coin_opt_coin_ratio
-            ) - pair.ratio
+        pairs, margins, _ = self.ratio_engine.get_margins(coin, coin_price)
+        ratio_dict: Dict[Pair, float] = dict(zip(pairs, margins.tolist()))
         return ratio_dict
 
     def _jump_to_best_coin(self, coin: Coin, coin_price: float):
         """
         Given a coin, search for a coin to jump to
         """
-        pair_ratios = self._get_ratios(coin, coin_price)
-
-        # keep only ratios bigger than zero
-        profitable_pairs = {k: v for k, v in pair_ratios.items() if v > 0}
+        pairs, margins, ratios = self.ratio_engine.get_margins(coin, coin_price)
+        if not pairs:
+            return
 
         # if we have any viable options, pick the one with the biggest ratio
-        if profitable_pairs:
-            best_pair = max(profitable_pairs, key=profitable_pairs.get)
+        best_index = int(np.argmax(margins))
+        if margins[best_index] > 0:
+            best_pair = pairs[best_index]
             self.logger.info(f"Will be jumping from {coin.symbol} to {best_pair.to_coin_id}")
             self.transaction_through_bridge(best_pair)
 
-        if self.config.LOSS_AFTER_HOURS > 0 and self.db.get_current_coin_date() + timedelta(hours=self.config.LOSS_AFTER_HOURS) < datetime.now():
+        if self.config.LOSS_AFTER_HOURS > 0 and self.db.get_current_coin_date() + timedelta(hours=self.config.LOSS_AFTER_HOURS) < self.manager.now():
             self.logger.debug("Have been stuck for more than a day, checking if we can settle for a loss")
             max_ratio_difference = (100 - self.config.MAX_LOSS_PERCENT) / 100
-            fallback_pairs = {k: v for k, v in pair_ratios.items() if ((v + k.ratio) / k.ratio) > max_ratio_difference}
-            if fallback_pairs:
-                best_pair = max(fallback_pairs, key=fallback_pairs.get)
-                loss_estimate = (1 - ((pair_ratios[best_pair] + best_pair.ratio) / best_pair.ratio)) * 100
+            relative_ratios = (margins + ratios) / ratios
+            fallback = relative_ratios > max_ratio_difference
+            if fallback.any():
+                best_index = int(np.argmax(np.where(fallback, margins, -np.inf)))
+                best_pair = pairs[best_index]
+                loss_estimate = (1 - relative_ratios[best_index]) * 100
                 self.logger.info(f"Will trade at a LOSS from {coin.symbol} to {best_pair.to_coin_id}, estimated loss {loss_estimate}%")
                 self.transaction_through_bridge(best_pair)
             else:
-                best_pair = max(pair_ratios, key=pair_ratios.get)
-                loss_estimate = (1 - ((pair_ratios[best_pair] + best_pair.ratio) / best_pair.ratio)) * 100
+                best_pair = pairs[best_index]
+                loss_estimate = (1 - relative_ratios[best_index]) * 100
                 self.logger.debug(f"Loss is currently too great with pair {best_pair.to_coin_id} at {loss_estimate}%")
 
     def bridge_scout(self):
@@ -193,19 +182,16 @@ class AutoTrader:
         """
         bridge_balance = self.manager.get_currency_balance(self.config.BRIDGE.symbol)
 
-        for coin in self.db.get_coins():
-            current_coin_price = self.manager.get_ticker_price(coin + self.config.BRIDGE)
+        prices, margins = self.ratio_engine.get_margin_matrix()
 
-            if current_coin_price is None:
-                continue
-
-            ratio_dict = self._get_ratios(coin, current_coin_price)
-            if not any(v > 0 for v in ratio_dict.values()):
-                # There will only be one coin where all the ratios are negative. When we find it, buy it if we can
-                if bridge_balance > self.manager.get_min_notional(coin.symbol, self.config.BRIDGE.symbol):
-                    self.logger.info(f"Will be purchasing {coin} using bridge coin")
-                    self.manager.buy_alt(coin, self.config.BRIDGE)
-                    return coin
+        # There will only be one coin where all the ratios are negative. When we find it, buy it if we can
+        candidates = np.flatnonzero(~np.isnan(prices) & ~(np.nan_to_num(margins, nan=0.0) > 0).any(axis=1))
+        for index in candidates:
+            coin = self.ratio_engine.coins[index]
+            if bridge_balance > self.manager.get_min_notional(coin.symbol, self.config.BRIDGE.symbol):
+                self.logger.info(f"Will be purchasing {coin} using bridge coin")
+                self.manager.buy_alt(coin, self.config.BRIDGE)
+                return coin
         return None
 
     def update_values(self):
@@ -216,6 +202,7 @@ class AutoTrader:
 
         session: Session
         with self.db.db_session() as session:
+            coin_values: List[CoinValue] = []
             coins: List[Coin] = session.query(Coin).all()
             for coin in coins:
                 balance = self.manager.get_currency_balance(coin.symbol)
@@ -223,6 +210,24 @@ class AutoTrader:
                     continue
                 usd_value = self.manager.get_ticker_price(coin + "USDT")
                 btc_value = self.manager.get_ticker_price(coin + "BTC")
-                cv = CoinValue(coin, balance, usd_value, btc_value, datetime=now)
+                previous = session.query(func.max(CoinValue.datetime)).filter(CoinValue.coin_id == coin.symbol).scalar()
+                cv = CoinValue(coin, balance, usd_value, btc_value, Interval.of(previous, now), now)
                 session.add(cv)
                 self.db.send_update(cv)
+                coin_values.append(cv)
+
+            if not coin_values:
+                return
+
+            # Summed like SQL would, skipping the coins without a price
+            usd_values = [cv.usd_value for cv in coin_values if cv.usd_value is not None]
+            btc_values = [cv.btc_value for cv in coin_values if cv.btc_value is not None]
+            previous = session.query(func.max(PortfolioValue.datetime)).scalar()
+            portfolio_value = PortfolioValue(
+                sum(usd_values) if usd_values else None,
+                sum(btc_values) if btc_values else None,
+                Interval.of(previous, now),
+                now,
+            )
+            session.add(portfolio_value)
+            self.db.send_update(portfolio_value)
@@ -1,19 +1,26 @@
 from collections import defaultdict
+import math
 from datetime import datetime, timedelta
 from traceback import format_exc
-from typing import Dict
+from typing import Callable, Dict, List, Tuple, Union
 
-from sqlitedict import SqliteDict
+import numpy as np
 
+from .auto_trader import AutoTrader
 from .binance_api_manager import BinanceAPIManager
 from .binance_stream_manager import BinanceOrder
 from .config import Config
 from .database import Database
+from .kline_store import UNFETCHED, KlineStore
 from .logger import Logger
 from .models import Coin, Pair
 from .strategies import get_strategy
 
 
+# Number of scouts looked ahead at once by event driven backtesting
+EVENT_WINDOW = 1000
+
+
 class MockBinanceManager(BinanceAPIManager):
     def __init__(
         self,
@@ -22,12 +29,14 @@ class MockBinanceManager(BinanceAPIManager):
         logger: Logger,
         start_date: datetime = None,
         start_balances: Dict[str, float] = None,
+        kline_store: KlineStore = None,
     ):
         super().__init__(config, db, logger)
         self.config = config
         self.datetime = start_date or datetime(2021, 1, 1)
         self.balances = start_balances or {config.BRIDGE.symbol: 100}
-        self.cache = SqliteDict("data/backtest_cache.db")
+        self.kline_store = kline_store or KlineStore("data/klines")
+        self.trade_count = 0
 
     def setup_websockets(self):
         pass  # No websockets are needed for backtesting
@@ -35,60 +44,67 @@ class MockBinanceManager(BinanceAPIManager):
     def increment(self, interval=1):
         self.datetime += timedelta(minutes=interval)
 
+    def now(self) -> datetime:
+        return self.datetime
+
     def get_fee(self, origin_coin: Coin, target_coin: Coin, selling: bool):
         return 0.0075
 
+    def get_fee_vector(
+        self, origin_symbols: Tuple[str, ...], target_symbol: str, selling: bool, indexes: np.ndarray
+    ) -> np.ndarray:
+        return np.full(len(origin_symbols), 0.0075)
+
     def get_ticker_price(self, ticker_symbol: str):
         """
         Get ticker price of a specific coin
         """
         target_date = self.datetime.replace(second=0, microsecond=0)
-        target_date_str = self.datetime.isoformat(timespec="seconds")
-
-        key = f"{ticker_symbol} - {target_date}"
-        val = self.cache.get(key, None)
-
-        if val is None:
-            end_date = self.datetime + timedelta(minutes=1000)
-            if end_date > datetime.now():
-                end_date = datetime.now()
-            end_date_str = end_date.isoformat(timespec="seconds")
-
-            self.logger.info(
-                f"Fetching prices for {ticker_symbol} between {target_date} and {end_date}"
-            )
-
-            # Use internal binance_client method because the public one doesn't
-            # actually pass on limits.
-            results = self.binance_client._historical_klines(
-                ticker_symbol,
-                "1m",
-                start_str=target_date_str,
-                end_str=end_date_str,
-                limit=1000
-            )
 
-            prices = {}
-            for result in results:
-                result_date = datetime.utcfromtimestamp(result[0] / 1000)
-                result_date = result_date.replace(second=0, microsecond=0)
+        try:
+            return self.kline_store.get(ticker_symbol, target_date)
+        except KeyError:
+            pass
 
-                price = float(result[1])
-                prices[f"{ticker_symbol} - {result_date}"] = price
+        self._fetch_prices(ticker_symbol, target_date)
+        return self.kline_store.get(ticker_symbol, target_date)
 
-            # Verify all intervals were returning, explicitly mark as missing
-            # otherwise so we can skip fetch.
-            for verify_date in (target_date + timedelta(minutes=n) for n in range(1000)):
-                verify_key = f"{ticker_symbol} - {verify_date}"
-                self.cache[verify_key] = prices.get(verify_key, "MISSING")
-
-            self.cache.commit()
-            val = self.cache.get(key, None)
-
-        if val == "MISSING":
-            return None
+    def get_ticker_prices(self, ticker_symbol: str, start_date: datetime, steps: int, interval=1) -> np.ndarray:
+        """
+        Get the ticker prices of a specific coin every `interval` minutes, NaN where there is no price
+        """
+        start_date = start_date.replace(second=0, microsecond=0)
+        end_date = start_date + timedelta(minutes=steps * interval)
+
+        prices = self.kline_store.get_range(ticker_symbol, start_date, end_date)[::interval]
+        unfetched = np.flatnonzero(prices == UNFETCHED)
+        while len(unfetched) > 0:
+            self._fetch_prices(ticker_symbol, start_date + timedelta(minutes=int(unfetched[0]) * interval))
+            prices = self.kline_store.get_range(ticker_symbol, start_date, end_date)[::interval]
+            unfetched = np.flatnonzero(prices == UNFETCHED)
+        return prices
+
+    def _fetch_prices(self, ticker_symbol: str, target_date: datetime):
+        end_date = target_date + timedelta(minutes=1000)
+        if end_date > datetime.now():
+            end_date = datetime.now()
+
+        self.logger.info(f"Fetching prices for {ticker_symbol} between {target_date} and {end_date}")
+
+        # Use internal binance_client method because the public one doesn't
+        # actually pass on limits.
+        results = self.binance_client._historical_klines(
+            ticker_symbol,
+            "1m",
+            start_str=target_date.isoformat(timespec="seconds"),
+            end_str=end_date.isoformat(timespec="seconds"),
+            limit=1000,
+        )
 
-        return val
+        # Explicitly mark all intervals as missing first, so that the ones
+        # Binance didn't return are skipped instead of fetched again.
+        self.kline_store.put(ticker_symbol, target_date, [None] * 1000)
+        self.kline_store.put_klines(ticker_symbol, results)
 
     def get_currency_balance(self, currency_symbol: str, force=False):
         """
@@ -105,6 +121,7 @@ class MockBinanceManager(BinanceAPIManager):
 
         order_quantity = self._buy_quantity(origin_symbol, target_symbol, target_balance, from_coin_price)
         target_quantity = order_quantity * from_coin_price
+        self.trade_count += 1
         self.balances[target_symbol] -= target_quantity
         self.balances[origin_symbol] = self.balances.get(origin_symbol, 0) + order_quantity * (
             1 - self.get_fee(origin_coin, target_coin, False)
@@ -127,6 +144,7 @@ class MockBinanceManager(BinanceAPIManager):
 
         order_quantity = self._sell_quantity(origin_symbol, target_symbol, origin_balance)
         target_quantity = order_quantity * from_coin_price
+        self.trade_count += 1
         self.balances[target_symbol] = self.balances.get(target_symbol, 0) + target_quantity * (
             1 - self.get_fee(origin_coin, target_coin, True)
         )
@@ -156,17 +174,77 @@ class MockBinanceManager(BinanceAPIManager):
         return total
 
     def close(self):
-        self.cache.close()
+        super().close()
+        self.kline_store.close()
 
 
 class MockDatabase(Database):
     def __init__(self, logger: Logger, config: Config):
         super().__init__(logger, config)
+        # Virtual clock of the backtest, so that the current coin date isn't wall-clock time
+        self.clock: Callable[[], datetime] = datetime.now
+        self.current_coin_date: datetime = None
+
+    def set_current_coin(self, coin: Union[Coin, str]):
+        super().set_current_coin(coin)
+        self.current_coin_date = self.clock()
+
+    def get_current_coin_date(self) -> datetime:
+        return self.current_coin_date or self.clock()
 
-    def log_scout(self, pair: Pair, target_ratio: float, current_coin_price: float, other_coin_price: float):
+    def log_scouts(
+        self,
+        pairs: List[Pair],
+        target_ratios: List[float],
+        current_coin_price: float,
+        other_coin_prices: List[float],
+    ):
         pass
 
 
+def _idle_scouts(
+    trader: AutoTrader, manager: MockBinanceManager, db: MockDatabase, config: Config, steps: int, interval
+):
+    """
+    Count how many of the next scouts, starting with the current one, can't possibly make a trade: no pair from
+    the current coin has a positive margin, and none is within the allowed loss once LOSS_AFTER_HOURS expired.
+    """
+    engine = trader.ratio_engine
+    engine.refresh()
+
+    current_coin = db.get_current_coin()
+    from_index = engine.coin_index.get(current_coin.symbol)
+    if from_index is None:
+        return steps
+    to_indexes = np.flatnonzero(~np.isnan(engine.ratios[from_index]))
+    if len(to_indexes) == 0:
+        return steps
+
+    start_date = manager.datetime
+    from_prices = manager.get_ticker_prices(current_coin + config.BRIDGE, start_date, steps, interval)
+    to_prices = np.stack(
+        [manager.get_ticker_prices(engine.coins[i] + config.BRIDGE, start_date, steps, interval) for i in to_indexes],
+        axis=1,
+    )
+    ratios = engine.ratios[from_index, to_indexes]
+    sell_fee = manager.get_fee(current_coin, config.BRIDGE, True)
+    buy_fees = engine.get_fees(to_indexes, False)[to_indexes]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        margins = engine.compute_margins(from_prices[:, None], to_prices, sell_fee, buy_fees, ratios)
+        triggers = margins > 0
+
+        if config.LOSS_AFTER_HOURS > 0:
+            loss_date = db.get_current_coin_date() + timedelta(hours=config.LOSS_AFTER_HOURS)
+            first_loss_step = max(math.floor((loss_date - start_date) / timedelta(minutes=interval)) + 1, 0)
+            max_ratio_difference = (100 - config.MAX_LOSS_PERCENT) / 100
+            fallback = (margins[first_loss_step:] + ratios) / ratios > max_ratio_difference
+            triggers[first_loss_step:] |= fallback
+
+    hits = np.flatnonzero(triggers.any(axis=1))
+    return int(hits[0]) if len(hits) > 0 else steps
+
+
 def backtest(
     start_date: datetime = None,
     end_date: datetime = None,
@@ -176,6 +254,8 @@ def backtest(
     starting_coin: str = None,
     config: Config = None,
     logger: Logger = None,
+    event_driven=False,
+    kline_store: KlineStore = None,
 ):
     """
 
@@ -187,6 +267,9 @@ def backtest(
     :param yield_interval: After how many intervals should the manager be yielded
     :param start_balances: A dictionary of initial coin values. Default: {BRIDGE: 100}
     :param starting_coin: The coin to start on. Default: first coin in coin list
+    :param event_driven: Skip straight to the next scout that can make a trade instead of scouting every interval.
+                         Only supported by the default strategy, gives the same results as scouting every interval
+    :param kline_store: Price store to use. Default: data/klines
 
     :return: The final coin balances
     """
@@ -198,34 +281,57 @@ def backtest(
     db = MockDatabase(logger, config)
     db.create_database()
     db.set_coins(config.SUPPORTED_COIN_LIST)
-    manager = MockBinanceManager(config, db, logger, start_date, start_balances)
-
-    starting_coin = db.get_coin(starting_coin or config.SUPPORTED_COIN_LIST[0])
-    if manager.get_currency_balance(starting_coin.symbol) == 0:
-        manager.buy_alt(starting_coin, config.BRIDGE)
-    db.set_current_coin(starting_coin)
-
-    strategy = get_strategy(config.STRATEGY)
-    if strategy is None:
-        logger.error("Invalid strategy name")
-        return manager
-    trader = strategy(manager, db, logger, config)
-    trader.initialize()
-
-    yield manager
-
-    n = 1
+    db.load_state()
+    manager = MockBinanceManager(config, db, logger, start_date, start_balances, kline_store)
+    db.clock = manager.now
+    # Closed however the backtest ends, including when the caller stops iterating early
     try:
-        while manager.datetime < end_date:
-            try:
-                trader.scout()
-            except Exception:  # pylint: disable=broad-except
-                logger.warning(format_exc())
-            manager.increment(interval)
-            if n % yield_interval == 0:
-                yield manager
-            n += 1
-    except KeyboardInterrupt:
-        pass
-    manager.close()
-    return manager
+        starting_coin = db.get_coin(starting_coin or config.SUPPORTED_COIN_LIST[0])
+        if manager.get_currency_balance(starting_coin.symbol) == 0:
+            manager.buy_alt(starting_coin, config.BRIDGE)
+        db.set_current_coin(starting_coin)
+
+        strategy = get_strategy(config.STRATEGY)
+        if strategy is None:
+            logger.error("Invalid strategy name")
+            return manager
+        trader = strategy(manager, db, logger, config)
+        trader.initialize()
+
+        if event_driven and config.STRATEGY != "default":
+            logger.warning(f"Event driven backtesting isn't supported by the {config.STRATEGY} strategy, disabling it")
+            event_driven = False
+
+        yield manager
+
+        n = 1
+        try:
+            while manager.datetime < end_date:
+                if event_driven:
+                    steps = min(math.ceil((end_date - manager.datetime) / timedelta(minutes=interval)), EVENT_WINDOW)
+                    idle = _idle_scouts(trader, manager, db, config, steps, interval)
+
+                    # Yield at the same points as when scouting every interval
+                    idle_start = manager.datetime
+                    for yield_n in range(math.ceil(n / yield_interval) * yield_interval, n + idle, yield_interval):
+                        manager.datetime = idle_start + timedelta(minutes=(yield_n - n + 1) * interval)
+                        yield manager
+                    manager.datetime = idle_start + timedelta(minutes=idle * interval)
+                    n += idle
+
+                    if idle == steps:
+                        continue
+
+                try:
+                    trader.scout()
+                except Exception:  # pylint: disable=broad-except
+                    logger.warning(format_exc())
+                manager.increment(interval)
+                if n % yield_interval == 0:
+                    yield manager
+                n += 1
+        except KeyboardInterrupt:
+            pass
+        return manager
+    finally:
+        manager.close()
@@ -1,32 +1,90 @@
 import math
 import time
 import traceback
-from typing import Dict, Optional
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Dict, List, Mapping, Optional, Sequence, Set, Tuple
 
-from binance.client import Client
+import numpy as np
 from binance.exceptions import BinanceAPIException
 from cachetools import TTLCache, cached
 
-from .binance_stream_manager import BinanceCache, BinanceOrder, BinanceStreamManager, OrderGuard
+from .binance_stream_manager import (
+    MARKET_STREAMS,
+    USER_STREAMS,
+    BinanceCache,
+    BinanceOrder,
+    BinanceStreamManager,
+    OrderGuard,
+    TickerCache,
+)
 from .config import Config
 from .database import Database
+from .exchange_client import ExchangeClient
+from .instrumentation import timed
 from .logger import Logger
 from .models import Coin
+from .symbol_filters import SymbolFilters, SymbolFilterTable
+
+
+# BNB burn status is only cached this long, so fees worked out from it can't be kept longer
+FEE_MODEL_TTL = 60
+
+
+class FeeModel:  # pylint: disable=too-few-public-methods
+    """
+    Fees worked out from one fetch of the trade fees and BNB burn setting. When fees are paid with BNB, the discount
+    also depends on balances, prices and lot sizes, and the model is only valid for the state it was built from.
+    """
+
+    def __init__(
+        self,
+        trade_fees: Dict[str, float],
+        using_bnb: bool,
+        prices: Mapping[str, float],
+        balances_version: int,
+        symbol_filters: Mapping[str, SymbolFilters],
+    ):
+        self.trade_fees = trade_fees
+        self.using_bnb = using_bnb
+        self.prices = prices
+        self.balances_version = balances_version
+        self.symbol_filters = symbol_filters
+        self.expires = time.monotonic() + FEE_MODEL_TTL
+        self.fees: Dict[Tuple[str, str, bool], float] = {}
+        # Fees of a sequence of coins, see BinanceAPIManager.get_fee_vector
+        self.vectors: Dict[Tuple[Tuple[str, ...], str, bool], np.ndarray] = {}
 
 
 class BinanceAPIManager:
-    def __init__(self, config: Config, db: Database, logger: Logger):
+    def __init__(self, config: Config, db: Database, logger: Logger, tickers: TickerCache = None):
+        """
+        :param tickers: Ticker prices kept up to date by a market data stream shared with other bots. Only the
+                        user data stream of this account is opened when given.
+        """
         # initializing the client class calls `ping` API endpoint, verifying the connection
-        self.binance_client = Client(
+        self.binance_client = ExchangeClient(
             config.BINANCE_API_KEY,
             config.BINANCE_API_SECRET_KEY,
             tld=config.BINANCE_TLD,
+            base_url=config.BINANCE_API_URL,
         )
         self.db = db
         self.logger = logger
         self.config = config
 
-        self.cache = BinanceCache()
+        self.symbol_filters = SymbolFilterTable(
+            self.binance_client, logger, f"data/exchange_info_{config.BINANCE_TLD}.json"
+        )
+        self.symbol_filters.load()
+
+        self.cache = BinanceCache(tickers)
+        self.shares_market_data = tickers is not None
+        # Ticker prices pinned by price_snapshot()
+        self._price_snapshot: Optional[Mapping[str, float]] = None
+        self._fee_model: Optional[FeeModel] = None
+        # Tickers this bot asked the cache to keep, None until watch_tickers() is called
+        self._watched_tickers: Optional[Set[str]] = None
         self.stream_manager: Optional[BinanceStreamManager] = None
         self.setup_websockets()
 
@@ -36,8 +94,17 @@ class BinanceAPIManager:
             self.config,
             self.binance_client,
             self.logger,
+            USER_STREAMS if self.shares_market_data else MARKET_STREAMS + USER_STREAMS,
         )
 
+    def close(self):
+        """
+        Stop the websockets and the REST client threads
+        """
+        if self.stream_manager is not None:
+            self.stream_manager.close()
+        self.binance_client.close()
+
     @cached(cache=TTLCache(maxsize=1, ttl=43200))
     def get_trade_fees(self) -> Dict[str, float]:
         return {ticker["symbol"]: ticker["taker"] for ticker in self.binance_client.get_trade_fee()["tradeFee"]}
@@ -46,28 +113,82 @@ class BinanceAPIManager:
     def get_using_bnb_for_fees(self):
         return self.binance_client.get_bnb_burn_spot_margin()["spotBNBBurn"]
 
+    def get_fee_model(self) -> FeeModel:
+        """
+        Fee model for the current state, rebuilt only when something the fees depend on changed
+        """
+        prices = self._price_snapshot if self._price_snapshot is not None else self.cache.ticker_values
+        model = self._fee_model
+        if (
+            model is None
+            or time.monotonic() >= model.expires
+            or (
+                model.using_bnb
+                and (
+                    model.prices is not prices
+                    or model.balances_version != self.cache.balances_version
+                    or model.symbol_filters is not self.symbol_filters.symbols
+                )
+            )
+        ):
+            model = self._fee_model = FeeModel(
+                self.get_trade_fees(),
+                self.get_using_bnb_for_fees(),
+                prices,
+                self.cache.balances_version,
+                self.symbol_filters.symbols,
+            )
+        return model
+
+    @timed()
     def get_fee(self, origin_coin: Coin, target_coin: Coin, selling: bool):
-        fees = self.get_trade_fees()
-        if not fees:
+        return self._model_fee(self.get_fee_model(), origin_coin.symbol, target_coin.symbol, selling)
+
+    def get_fee_vector(
+        self, origin_symbols: Tuple[str, ...], target_symbol: str, selling: bool, indexes: np.ndarray
+    ) -> np.ndarray:
+        """
+        Fees of trading each of the origin coins for the target coin, filled in for the given indexes and NaN for
+        the coins that weren't asked for yet. The vector is kept by the fee model, so as long as the model holds,
+        asking again costs nothing. It is shared, so it must not be modified.
+        """
+        model = self.get_fee_model()
+        key = (origin_symbols, target_symbol, selling)
+        fees = model.vectors.get(key)
+        if fees is None:
+            fees = model.vectors[key] = np.full(len(origin_symbols), np.nan)
+        for i in indexes[np.isnan(fees[indexes])]:
+            fees[i] = self._model_fee(model, origin_symbols[i], target_symbol, selling)
+        return fees
+
+    def _model_fee(self, model: FeeModel, origin_symbol: str, target_symbol: str, selling: bool):
+        key = (origin_symbol, target_symbol, selling)
+        fee = model.fees.get(key)
+        if fee is None:
+            fee = model.fees[key] = self._compute_fee(model, origin_symbol, target_symbol, selling)
+        return fee
+
+    def _compute_fee(self, model: FeeModel, origin_symbol: str, target_symbol: str, selling: bool):
+        if not model.trade_fees:
             base_fee = 0.001
         else:
-            base_fee = fees[origin_coin + target_coin]
+            base_fee = model.trade_fees[origin_symbol + target_symbol]
 
-        if not self.get_using_bnb_for_fees():
+        if not model.using_bnb:
             return base_fee
 
         # The discount is only applied if we have enough BNB to cover the fee
         amount_trading = (
-            self._sell_quantity(origin_coin.symbol, target_coin.symbol)
+            self._sell_quantity(origin_symbol, target_symbol)
             if selling
-            else self._buy_quantity(origin_coin.symbol, target_coin.symbol)
+            else self._buy_quantity(origin_symbol, target_symbol)
         )
 
         fee_amount = amount_trading * base_fee * 0.75
-        if origin_coin.symbol == "BNB":
+        if origin_symbol == "BNB":
             fee_amount_bnb = fee_amount
         else:
-            origin_price = self.get_ticker_price(origin_coin + Coin("BNB"))
+            origin_price = self.get_ticker_price(origin_symbol + "BNB")
             if origin_price is None:
                 return base_fee
             fee_amount_bnb = fee_amount * origin_price
@@ -78,51 +199,115 @@ class BinanceAPIManager:
             return base_fee * 0.75
         return base_fee
 
+    def now(self) -> datetime:
+        """
+        Get the current time as seen by the exchange
+        """
+        return datetime.now()
+
     def get_account(self):
         """
         Get account information
         """
         return self.binance_client.get_account()
 
+    def watch_tickers(self, coins: List[Coin]):
+        """
+        Only keep the prices of the tickers needed to trade the given coins, pay fees and value the balances.
+        Must be called again when the coin list changes.
+        """
+        quotes = {self.config.BRIDGE.symbol, "BTC", "USDT", "BNB"}
+        assets = {coin.symbol for coin in coins} | quotes
+        self._watched_tickers = {asset + quote for asset in assets for quote in quotes if asset != quote}
+        self.cache.tickers.watch(self, self._watched_tickers)
+
+    @timed()
     def get_ticker_price(self, ticker_symbol: str):
         """
         Get ticker price of a specific coin
         """
-        price = self.cache.ticker_values.get(ticker_symbol, None)
-        if price is None and ticker_symbol not in self.cache.non_existent_tickers:
-            self.cache.ticker_values = {
-                ticker["symbol"]: float(ticker["price"]) for ticker in self.binance_client.get_symbol_ticker()
-            }
-            self.logger.debug(f"Fetched all ticker prices: {self.cache.ticker_values}")
-            price = self.cache.ticker_values.get(ticker_symbol, None)
+        prices = self._price_snapshot if self._price_snapshot is not None else self.cache.ticker_values
+        price = prices.get(ticker_symbol, None)
+        if price is None and not self.cache.tickers.is_non_existent(ticker_symbol):
+            if self._watched_tickers is not None and ticker_symbol not in self._watched_tickers:
+                # Keep it up to date from now on
+                self._watched_tickers.add(ticker_symbol)
+                self.cache.tickers.watch(self, self._watched_tickers)
+            prices = self.cache.update_ticker_values(
+                {ticker["symbol"]: float(ticker["price"]) for ticker in self.binance_client.get_symbol_ticker()}
+            )
+            if self._price_snapshot is not None:
+                self._price_snapshot = prices
+            self.logger.debug(f"Fetched all ticker prices: {dict(prices)}")
+            price = prices.get(ticker_symbol, None)
             if price is None:
                 self.logger.debug(f"Ticker does not exist: {ticker_symbol} - will not be fetched from now on")
-                self.cache.non_existent_tickers.add(ticker_symbol)
+                self.cache.tickers.set_non_existent(ticker_symbol)
 
         return price
 
+    def get_ticker_price_vector(self, symbols: Sequence[str], indexes: np.ndarray) -> np.ndarray:
+        """
+        Prices of the given tickers read from the cache at once. Those of the given indexes which aren't cached are
+        looked up like get_ticker_price does, tickers without a price are NaN.
+        """
+        prices = self._price_snapshot if self._price_snapshot is not None else self.cache.ticker_values
+        vector = np.array([prices.get(symbol, np.nan) for symbol in symbols], dtype=float)
+        for i in indexes[np.isnan(vector[indexes])]:
+            price = self.get_ticker_price(symbols[i])
+            if price is not None:
+                vector[i] = price
+        return vector
+
+    @contextmanager
+    def price_snapshot(self):
+        """
+        Read all ticker prices from the same snapshot of the cache while inside the context, so that prices which
+        are compared with each other come from the same moment. Nested contexts keep the outer snapshot.
+        """
+        if self._price_snapshot is not None:
+            yield
+            return
+        self._price_snapshot = self.cache.ticker_values
+        try:
+            yield
+        finally:
+            self._price_snapshot = None
+
+    @contextmanager
+    def live_prices(self):
+        """
+        Read the latest ticker prices while inside the context, even within a price snapshot. Orders are priced
+        at, and wait on, the market as it is now.
+        """
+        snapshot, self._price_snapshot = self._price_snapshot, None
+        try:
+            yield
+        finally:
+            self._price_snapshot = snapshot
+
     def get_currency_balance(self, currency_symbol: str, force=False) -> float:
         """
         Get balance of a specific coin
         """
-        with self.cache.open_balances() as cache_balances:
-            balance = cache_balances.get(currency_symbol, None)
-            if force or balance is None:
-                cache_balances.clear()
-                cache_balances.update(
-                    {
-                        currency_balance["asset"]: float(currency_balance["free"])
-                        for currency_balance in self.binance_client.get_account()["balances"]
-                    }
-                )
-                self.logger.debug(f"Fetched all balances: {cache_balances}")
-                if currency_symbol not in cache_balances:
-                    cache_balances[currency_symbol] = 0.0
-                    return 0.0
-                return cache_balances.get(currency_symbol, 0.0)
-
+        balance = None if force else self.cache.get_balance(currency_symbol)
+        if balance is not None:
             return balance
 
+        with self.cache.open_balances() as cache_balances:
+            cache_balances.clear()
+            cache_balances.update(
+                {
+                    currency_balance["asset"]: float(currency_balance["free"])
+                    for currency_balance in self.binance_client.get_account()["balances"]
+                }
+            )
+            self.logger.debug(f"Fetched all balances: {cache_balances}")
+            if currency_symbol not in cache_balances:
+                cache_balances[currency_symbol] = 0.0
+                return 0.0
+            return cache_balances.get(currency_symbol, 0.0)
+
     def retry(self, func, *args, **kwargs):
         time.sleep(1)
         attempts = 0
@@ -136,40 +321,31 @@ class BinanceAPIManager:
                 attempts += 1
         return None
 
-    def get_symbol_filter(self, origin_symbol: str, target_symbol: str, filter_type: str):
-        return next(
-            _filter
-            for _filter in self.binance_client.get_symbol_info(origin_symbol + target_symbol)["filters"]
-            if _filter["filterType"] == filter_type
-        )
+    def get_symbol_filters(self, origin_symbol: str, target_symbol: str) -> SymbolFilters:
+        filters = self.symbol_filters.get(origin_symbol + target_symbol)
+        if filters is None:
+            # The symbol filters are being refreshed in case it was just listed, a retry will see it
+            raise ValueError(f"Symbol {origin_symbol + target_symbol} isn't traded on Binance")
+        return filters
 
-    @cached(cache=TTLCache(maxsize=2000, ttl=43200))
     def get_alt_tick(self, origin_symbol: str, target_symbol: str):
-        step_size = self.get_symbol_filter(origin_symbol, target_symbol, "LOT_SIZE")["stepSize"]
-        if step_size.find("1") == 0:
-            return 1 - step_size.find(".")
-        return step_size.find("1") - 1
+        return self.get_symbol_filters(origin_symbol, target_symbol).alt_tick
 
-    @cached(cache=TTLCache(maxsize=2000, ttl=43200))
     def get_min_notional(self, origin_symbol: str, target_symbol: str):
-        return float(self.get_symbol_filter(origin_symbol, target_symbol, "MIN_NOTIONAL")["minNotional"])
+        return self.get_symbol_filters(origin_symbol, target_symbol).min_notional
 
     def _wait_for_order(
         self, order_id, origin_symbol: str, target_symbol: str
     ) -> Optional[BinanceOrder]:  # pylint: disable=unsubscriptable-object
-        while True:
-            order_status: BinanceOrder = self.cache.orders.get(order_id, None)
-            if order_status is not None:
-                break
+        order_status: BinanceOrder = self.cache.get_order(order_id)
+        while order_status is None:
             self.logger.debug(f"Waiting for order {order_id} to be created")
-            time.sleep(1)
+            order_status = self.cache.wait_for_order(order_id, None, 60)
 
         self.logger.debug(f"Order created: {order_status}")
 
         while order_status.status != "FILLED":
             try:
-                order_status = self.cache.orders.get(order_id, order_status)
-
                 self.logger.debug(f"Waiting for order {order_id} to be filled")
 
                 if self._should_cancel_order(order_status):
@@ -198,7 +374,8 @@ class BinanceAPIManager:
                     self.logger.info("Order is canceled, going back to scouting mode...")
                     return None
 
-                time.sleep(1)
+                # Execution reports wake us up straight away, the timeout is only there to cancel the order in time
+                order_status = self.cache.wait_for_order(order_id, order_status, self._order_wait_time(order_status))
             except BinanceAPIException as e:
                 self.logger.info(e)
                 time.sleep(1)
@@ -210,20 +387,37 @@ class BinanceAPIManager:
 
         return order_status
 
+    @timed()
     def wait_for_order(
         self, order_id, origin_symbol: str, target_symbol: str, order_guard: OrderGuard
     ) -> Optional[BinanceOrder]:  # pylint: disable=unsubscriptable-object
         with order_guard:
-            return self._wait_for_order(order_id, origin_symbol, target_symbol)
+            try:
+                return self._wait_for_order(order_id, origin_symbol, target_symbol)
+            finally:
+                self.cache.forget_order(order_id)
+
+    def _order_timeout(self, order_status) -> float:
+        """
+        Minutes after which an unfilled order is canceled, 0 to never cancel it
+        """
+        if order_status.side == "SELL":
+            return float(self.config.SELL_TIMEOUT)
+        return float(self.config.BUY_TIMEOUT)
+
+    def _order_wait_time(self, order_status) -> Optional[float]:  # pylint: disable=unsubscriptable-object
+        """
+        Seconds to wait for the next report of an order before checking whether it should be canceled
+        """
+        timeout = self._order_timeout(order_status)
+        if not timeout:
+            return None
+        # Once timed out, partially filled buys are only canceled when the price moved, so keep checking it
+        return max(order_status.time / 1000 + timeout * 60 - time.time(), 1)
 
     def _should_cancel_order(self, order_status):
         minutes = (time.time() - order_status.time / 1000) / 60
-        timeout = 0
-
-        if order_status.side == "SELL":
-            timeout = float(self.config.SELL_TIMEOUT)
-        else:
-            timeout = float(self.config.BUY_TIMEOUT)
+        timeout = self._order_timeout(order_status)
 
         if timeout and minutes > timeout and order_status.status == "NEW":
             return True
@@ -239,8 +433,10 @@ class BinanceAPIManager:
 
         return False
 
+    @timed()
     def buy_alt(self, origin_coin: Coin, target_coin: Coin) -> BinanceOrder:
-        return self.retry(self._buy_alt, origin_coin, target_coin)
+        with self.live_prices():
+            return self.retry(self._buy_alt, origin_coin, target_coin)
 
     def _buy_quantity(
         self, origin_symbol: str, target_symbol: str, target_balance: float = None, from_coin_price: float = None
@@ -303,8 +499,10 @@ class BinanceAPIManager:
 
         return order
 
+    @timed()
     def sell_alt(self, origin_coin: Coin, target_coin: Coin) -> BinanceOrder:
-        return self.retry(self._sell_alt, origin_coin, target_coin)
+        with self.live_prices():
+            return self.retry(self._sell_alt, origin_coin, target_coin)
 
     def _sell_quantity(self, origin_symbol: str, target_symbol: str, origin_balance: float = None):
         origin_balance = origin_balance or self.get_currency_balance(origin_symbol)
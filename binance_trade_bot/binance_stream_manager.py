@@ -1,14 +1,20 @@
-import sys
+import json
+import queue
+import re
 import threading
 import time
+from concurrent.futures import as_completed
 from contextlib import contextmanager
-from typing import Dict, Set, Tuple
+from types import MappingProxyType
+from typing import Dict, FrozenSet, Hashable, Iterable, List, Mapping, Optional, Sequence, Set, Tuple
 
-import binance.client
 from binance.exceptions import BinanceAPIException, BinanceRequestException
+from cachetools import TTLCache
 from unicorn_binance_websocket_api import BinanceWebSocketApiManager
 
 from .config import Config
+from .exchange_client import ExchangeClient
+from .instrumentation import instrumentation
 from .logger import Logger
 
 
@@ -28,17 +34,146 @@ class BinanceOrder:  # pylint: disable=too-few-public-methods
         return f"<BinanceOrder {self.event}>"
 
 
+# Reports of orders nobody waits for (finished orders, other bots or manual trades on the account) are only kept
+# for so long, and at most this many of them
+ORDER_CACHE_SIZE = 1000
+ORDER_CACHE_TTL = 60 * 60
+# Tickers that don't exist are retried after a day, in case they got listed
+NON_EXISTENT_TICKER_TTL = 24 * 60 * 60
+
+
+class TickerCache:
+    """
+    Ticker prices of an exchange, which can be shared by the caches of several accounts.
+
+    Prices are published as immutable snapshots: writers replace the whole mapping, so readers can hold on to one
+    without any lock and see a consistent set of prices while updates keep coming in.
+
+    Once something is watched, only the prices of watched tickers are kept.
+    """
+
+    def __init__(self):
+        self.values: Mapping[str, float] = MappingProxyType({})
+        self.version = 0
+        self._mutex = threading.Lock()
+        # Used as a set, values are always True. Not thread-safe by itself, only used under the mutex.
+        self._non_existent: TTLCache = TTLCache(maxsize=1000, ttl=NON_EXISTENT_TICKER_TTL)
+        # Union of the tickers watched by every user of the cache, None to keep them all
+        self.watched: Optional[FrozenSet[str]] = None
+        self._watched_by: Dict[Hashable, FrozenSet[str]] = {}
+
+    def watch(self, owner: Hashable, symbols: Iterable[str]):
+        """
+        Replace the tickers watched by `owner`, and drop the prices nobody watches anymore
+        """
+        with self._mutex:
+            self._watched_by[owner] = frozenset(symbols)
+            self.watched = frozenset().union(*self._watched_by.values())
+            self.values = MappingProxyType({s: p for s, p in self.values.items() if s in self.watched})
+            self.version += 1
+
+    def is_non_existent(self, symbol: str) -> bool:
+        with self._mutex:
+            return symbol in self._non_existent
+
+    def set_non_existent(self, symbol: str):
+        """
+        Remember that a ticker doesn't exist, so that it isn't looked up again for a while
+        """
+        with self._mutex:
+            self._non_existent[symbol] = True
+
+    def non_existent_count(self) -> int:
+        with self._mutex:
+            # Expires the old entries first
+            self._non_existent.expire()
+            return len(self._non_existent)
+
+    def update(self, values: Dict[str, float]) -> Mapping[str, float]:
+        """
+        Publish a new snapshot with the given prices updated, and return it
+        """
+        with self._mutex:
+            watched = self.watched
+            if watched is not None:
+                values = {symbol: price for symbol, price in values.items() if symbol in watched}
+            self.values = MappingProxyType({**self.values, **values})
+            self.version += 1
+            return self.values
+
+
 class BinanceCache:  # pylint: disable=too-few-public-methods
-    ticker_values: Dict[str, float] = {}
-    _balances: Dict[str, float] = {}
-    _balances_mutex: threading.Lock = threading.Lock()
-    non_existent_tickers: Set[str] = set()
-    orders: Dict[str, BinanceOrder] = {}
+    """
+    Prices, balances and orders of one Binance account, each behind its own lock
+    """
+
+    def __init__(self, tickers: TickerCache = None, max_orders=ORDER_CACHE_SIZE, order_ttl=ORDER_CACHE_TTL):
+        self.tickers = tickers or TickerCache()
+
+        self._balances: Dict[str, float] = {}
+        self._balances_mutex = threading.Lock()
+        # Bumped whenever the balances were opened for changing them
+        self.balances_version = 0
+
+        self.orders: TTLCache = TTLCache(maxsize=max_orders, ttl=order_ttl)
+        self._orders_changed = threading.Condition()
+
+    @property
+    def ticker_values(self) -> Mapping[str, float]:
+        """
+        Latest snapshot of the ticker prices, never modified once returned
+        """
+        return self.tickers.values
+
+    @property
+    def ticker_version(self) -> int:
+        return self.tickers.version
+
+    def update_ticker_values(self, values: Dict[str, float]) -> Mapping[str, float]:
+        return self.tickers.update(values)
 
     @contextmanager
     def open_balances(self):
         with self._balances_mutex:
-            yield self._balances
+            try:
+                yield self._balances
+            finally:
+                self.balances_version += 1
+
+    def get_balance(self, symbol: str) -> Optional[float]:  # pylint: disable=unsubscriptable-object
+        with self._balances_mutex:
+            return self._balances.get(symbol)
+
+    def set_order(self, order: BinanceOrder):
+        """
+        Store the latest report of an order and wake up whoever is waiting for it
+        """
+        with self._orders_changed:
+            self.orders[order.id] = order
+            self._orders_changed.notify_all()
+
+    def wait_for_order(
+        self, order_id, last_report: Optional[BinanceOrder], timeout: Optional[float]
+    ) -> Optional[BinanceOrder]:  # pylint: disable=unsubscriptable-object
+        """
+        Wait up to `timeout` seconds (forever if None) for a report of the order other than `last_report`, and
+        return the latest report
+        """
+        with self._orders_changed:
+            # An evicted report doesn't count as a new one, keep waiting for the next
+            self._orders_changed.wait_for(lambda: self.orders.get(order_id, last_report) is not last_report, timeout)
+            return self.orders.get(order_id, last_report)
+
+    def get_order(self, order_id) -> Optional[BinanceOrder]:  # pylint: disable=unsubscriptable-object
+        with self._orders_changed:
+            return self.orders.get(order_id)
+
+    def forget_order(self, order_id):
+        """
+        Drop the reports of an order once it has been dealt with
+        """
+        with self._orders_changed:
+            self.orders.pop(order_id, None)
 
 
 class OrderGuard:
@@ -65,19 +200,68 @@ class OrderGuard:
         self.pending_orders.remove(self.tag)
 
 
+# Streams of the market data and of the account
+MARKET_STREAMS = ("!miniTicker",)
+USER_STREAMS = ("!userData",)
+
+# Kinds of events handed to the stream processor
+STREAM_DATA = "data"
+STREAM_TICKERS = "tickers"
+STREAM_SIGNAL = "signal"
+STREAM_STOP = "stop"
+
+# Symbol and close price of every ticker of a raw !miniTicker message, and the time of its first event
+TICKER_PRICE_RE = re.compile(r'"s":"(\w+)","c":"([^"]*)"')
+EVENT_TIME_RE = re.compile(r'"E":(\d+)')
+
+
+class QueueingWebSocketApiManager(BinanceWebSocketApiManager):
+    """
+    Websocket manager that puts stream data and stream signals on a queue as soon as they arrive, instead of
+    leaving them in buffers that have to be polled
+    """
+
+    def __init__(self, events: queue.Queue, **kwargs):
+        self.events = events
+        super().__init__(process_stream_data=self._put_stream_data, enable_stream_signal_buffer=True, **kwargs)
+
+    def _put_stream_data(self, stream_data, stream_buffer_name=False):
+        # The buffer name of a stream tells what kind of data it carries
+        self.events.put((stream_buffer_name or STREAM_DATA, stream_data))
+
+    def add_to_stream_signal_buffer(self, signal_type=False, stream_id=False, data_record=False):
+        result = super().add_to_stream_signal_buffer(signal_type, stream_id, data_record)
+        stream_signal = self.pop_stream_signal_from_stream_signal_buffer()
+        if stream_signal is not False:
+            self.events.put((STREAM_SIGNAL, stream_signal))
+        return result
+
+
 class BinanceStreamManager:
-    def __init__(self, cache: BinanceCache, config: Config, binance_client: binance.client.Client, logger: Logger):
+    def __init__(
+        self,
+        cache: BinanceCache,
+        config: Config,
+        binance_client: ExchangeClient,
+        logger: Logger,
+        streams: Sequence[str] = MARKET_STREAMS + USER_STREAMS,
+    ):
         self.cache = cache
         self.logger = logger
-        self.bw_api_manager = BinanceWebSocketApiManager(
-            output_default="UnicornFy", enable_stream_signal_buffer=True, exchange=f"binance.{config.BINANCE_TLD}"
-        )
-        self.bw_api_manager.create_stream(
-            ["arr"], ["!miniTicker"], api_key=config.BINANCE_API_KEY, api_secret=config.BINANCE_API_SECRET_KEY
-        )
-        self.bw_api_manager.create_stream(
-            ["arr"], ["!userData"], api_key=config.BINANCE_API_KEY, api_secret=config.BINANCE_API_SECRET_KEY
+        self.events: queue.Queue = queue.Queue()
+        self.bw_api_manager = QueueingWebSocketApiManager(
+            self.events, output_default="UnicornFy", exchange=f"binance.{config.BINANCE_TLD}"
         )
+        for stream in streams:
+            if stream in MARKET_STREAMS:
+                # Ticker arrays are left as raw json, so that the tickers nobody watches are never decoded
+                self.bw_api_manager.create_stream(
+                    ["arr"], [stream], stream_buffer_name=STREAM_TICKERS, output="raw_data"
+                )
+            else:
+                self.bw_api_manager.create_stream(
+                    ["arr"], [stream], api_key=config.BINANCE_API_KEY, api_secret=config.BINANCE_API_SECRET_KEY
+                )
         self.binance_client = binance_client
         self.pending_orders: Set[Tuple[str, int]] = set()
         self.pending_orders_mutex: threading.Lock = threading.Lock()
@@ -87,20 +271,26 @@ class BinanceStreamManager:
     def acquire_order_guard(self):
         return OrderGuard(self.pending_orders, self.pending_orders_mutex)
 
+    def _fetch_pending_order(self, symbol: str, order_id: int):
+        while True:
+            try:
+                return self.binance_client.get_order(symbol=symbol, orderId=order_id)
+            except (BinanceRequestException, BinanceAPIException) as e:
+                self.logger.error(f"Got exception during fetching pending order: {e}")
+            time.sleep(1)
+
     def _fetch_pending_orders(self):
         pending_orders: Set[Tuple[str, int]]
         with self.pending_orders_mutex:
             pending_orders = self.pending_orders.copy()
-        for (symbol, order_id) in pending_orders:
-            order = None
-            while True:
-                try:
-                    order = self.binance_client.get_order(symbol=symbol, orderId=order_id)
-                except (BinanceRequestException, BinanceAPIException) as e:
-                    self.logger.error(f"Got exception during fetching pending order: {e}")
-                if order is not None:
-                    break
-                time.sleep(1)
+        # The orders are independent, fetch them all at once and hand each one over as soon as it arrives
+        futures = {
+            self.binance_client.submit(self._fetch_pending_order, symbol, order_id): (symbol, order_id)
+            for (symbol, order_id) in pending_orders
+        }
+        for future in as_completed(futures):
+            symbol, order_id = futures[future]
+            order = future.result()
             fake_report = {
                 "symbol": order["symbol"],
                 "side": order["side"],
@@ -112,7 +302,7 @@ class BinanceStreamManager:
                 "transaction_time": order["time"],
             }
             self.logger.info(f"Pending order {order_id} for symbol {symbol} fetched:\n{fake_report}", False)
-            self.cache.orders[fake_report["order_id"]] = BinanceOrder(fake_report)
+            self.cache.set_order(BinanceOrder(fake_report))
 
     def _invalidate_balances(self):
         with self.cache.open_balances() as balances:
@@ -120,32 +310,37 @@ class BinanceStreamManager:
 
     def _stream_processor(self):
         while True:
-            if self.bw_api_manager.is_manager_stopping():
-                sys.exit()
-
-            stream_signal = self.bw_api_manager.pop_stream_signal_from_stream_signal_buffer()
-            stream_data = self.bw_api_manager.pop_stream_data_from_stream_buffer()
-
-            if stream_signal is not False:
-                signal_type = stream_signal["type"]
-                stream_id = stream_signal["stream_id"]
-                if signal_type == "CONNECT":
-                    stream_info = self.bw_api_manager.get_stream_info(stream_id)
-                    if "!userData" in stream_info["markets"]:
-                        self.logger.debug("Connect for userdata arrived")
-                        self._fetch_pending_orders()
-                        self._invalidate_balances()
-            if stream_data is not False:
-                self._process_stream_data(stream_data)
-            if stream_data is False and stream_signal is False:
-                time.sleep(0.01)
+            # Blocks until the websocket manager hands over something, so an idle stream costs nothing
+            kind, payload = self.events.get()
+            if kind == STREAM_STOP or self.bw_api_manager.is_manager_stopping():
+                return
+
+            if kind == STREAM_SIGNAL:
+                self._process_stream_signal(payload)
+            elif kind == STREAM_TICKERS:
+                self._process_tickers(payload)
+            else:
+                self._process_stream_data(payload)
+
+    def _process_stream_signal(self, stream_signal):
+        if stream_signal["type"] == "DISCONNECT":
+            instrumentation.count("stream_disconnects")
+        if stream_signal["type"] == "CONNECT":
+            instrumentation.count("stream_connects")
+            stream_info = self.bw_api_manager.get_stream_info(stream_signal["stream_id"])
+            if "!userData" in stream_info["markets"]:
+                self.logger.debug("Connect for userdata arrived")
+                self._fetch_pending_orders()
+                self._invalidate_balances()
 
     def _process_stream_data(self, stream_data):
         event_type = stream_data["event_type"]
+        if "event_time" in stream_data:
+            # Includes the difference between the local and exchange clocks
+            instrumentation.record("BinanceStreamManager.event_lag", time.time() - stream_data["event_time"] / 1000)
         if event_type == "executionReport":  # !userData
             self.logger.debug(f"execution report: {stream_data}")
-            order = BinanceOrder(stream_data)
-            self.cache.orders[order.id] = order
+            self.cache.set_order(BinanceOrder(stream_data))
         elif event_type == "balanceUpdate":  # !userData
             self.logger.debug(f"Balance update: {stream_data}")
             with self.cache.open_balances() as balances:
@@ -157,11 +352,36 @@ class BinanceStreamManager:
             with self.cache.open_balances() as balances:
                 for bal in stream_data["balances"]:
                     balances[bal["asset"]] = float(bal["free"])
-        elif event_type == "24hrMiniTicker":
-            for event in stream_data["data"]:
-                self.cache.ticker_values[event["symbol"]] = float(event["close_price"])
         else:
             self.logger.error(f"Unknown event type found: {event_type}\n{stream_data}")
 
+    @staticmethod
+    def _decode_tickers(message: str) -> List[dict]:
+        tickers = json.loads(message)
+        if isinstance(tickers, dict) and "stream" in tickers:
+            # The websocket manager opens the market stream as a combined stream, which wraps every message
+            tickers = tickers["data"]
+        if not isinstance(tickers, list):
+            # Subscription results and errors, the websocket manager already logs those
+            return []
+        return tickers
+
+    def _process_tickers(self, message: str):
+        # Picking the prices out of the raw message is several times faster than decoding its ~1500 tickers
+        prices = TICKER_PRICE_RE.findall(message)
+        if len(prices) != message.count('"s":'):
+            # Not laid out as Binance usually does
+            prices = [(ticker["s"], ticker["c"]) for ticker in self._decode_tickers(message)]
+        if not prices:
+            return
+        event_time = EVENT_TIME_RE.search(message)
+        if event_time is not None:
+            instrumentation.record("BinanceStreamManager.event_lag", time.time() - int(event_time.group(1)) / 1000)
+        watched = self.cache.tickers.watched
+        self.cache.update_ticker_values(
+            {symbol: float(price) for symbol, price in prices if watched is None or symbol in watched}
+        )
+
     def close(self):
         self.bw_api_manager.stop_manager_with_all_streams()
+        self.events.put((STREAM_STOP, None))
@@ -5,11 +5,12 @@ import os
 from .models import Coin
 
 CFG_FL_NAME = "user.cfg"
+COIN_LIST_FL_NAME = "supported_coin_list"
 USER_CFG_SECTION = "binance_user_config"
 
 
 class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attributes
-    def __init__(self):
+    def __init__(self, config_file=CFG_FL_NAME, coin_list_file=COIN_LIST_FL_NAME):
         # Init config
         config = configparser.ConfigParser()
         config["DEFAULT"] = {
@@ -17,23 +18,26 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
             "scout_multiplier": "5",
             "scout_sleep_time": "5",
             "hourToKeepScoutHistory": "1",
+            "scout_history_ring_size": "0",
             "tld": "com",
+            "api_url": "",
             "strategy": "default",
             "sell_timeout": "0",
             "buy_timeout": "0",
             "notification_name": "trader",
             "enable_api": "False",
+            "profile_token": "",
             "db_uri": "sqlite:///data/crypto_trading.db",
             "loss_after_hours": "0",
             "max_loss_percent": "15",
             "log_progress_after_hours": "12"
         }
 
-        if not os.path.exists(CFG_FL_NAME):
-            print("No configuration file (user.cfg) found! See README. Assuming default config...")
+        if not os.path.exists(config_file):
+            print(f"No configuration file ({config_file}) found! See README. Assuming default config...")
             config[USER_CFG_SECTION] = {}
         else:
-            config.read(CFG_FL_NAME)
+            config.read(config_file)
 
         self.BRIDGE_SYMBOL = os.environ.get("BRIDGE_SYMBOL") or config.get(USER_CFG_SECTION, "bridge")
         self.BRIDGE = Coin(self.BRIDGE_SYMBOL, False)
@@ -42,6 +46,9 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
         self.SCOUT_HISTORY_PRUNE_TIME = float(
             os.environ.get("HOURS_TO_KEEP_SCOUTING_HISTORY") or config.get(USER_CFG_SECTION, "hourToKeepScoutHistory")
         )
+        self.SCOUT_HISTORY_RING_SIZE = int(
+            os.environ.get("SCOUT_HISTORY_RING_SIZE") or config.get(USER_CFG_SECTION, "scout_history_ring_size")
+        )
 
         # Get config for scout
         self.SCOUT_MULTIPLIER = float(
@@ -55,14 +62,16 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
         self.BINANCE_API_KEY = os.environ.get("API_KEY") or config.get(USER_CFG_SECTION, "api_key")
         self.BINANCE_API_SECRET_KEY = os.environ.get("API_SECRET_KEY") or config.get(USER_CFG_SECTION, "api_secret_key")
         self.BINANCE_TLD = os.environ.get("TLD") or config.get(USER_CFG_SECTION, "tld")
+        # Talk to another exchange than Binance, e.g. a local mock exchange
+        self.BINANCE_API_URL = os.environ.get("API_URL") or config.get(USER_CFG_SECTION, "api_url") or None
 
         # Get supported coin list from the environment
         supported_coin_list = [
             coin.strip() for coin in os.environ.get("SUPPORTED_COIN_LIST", "").split() if coin.strip()
         ]
         # Get supported coin list from supported_coin_list file
-        if not supported_coin_list and os.path.exists("supported_coin_list"):
-            with open("supported_coin_list") as rfh:
+        if not supported_coin_list and os.path.exists(coin_list_file):
+            with open(coin_list_file) as rfh:
                 for line in rfh:
                     line = line.strip()
                     if not line or line.startswith("#") or line in supported_coin_list:
@@ -79,6 +88,7 @@ class Config:  # pylint: disable=too-few-public-methods,too-many-instance-attrib
         self.NOTIFICATION_NAME = os.environ.get("NOTIFICATION_NAME") or config.get(USER_CFG_SECTION, "notification_name")
         self.ENABLE_API = os.environ.get("ENABLE_API") or config.get(USER_CFG_SECTION, "enable_api")
         self.ENABLE_API = self.ENABLE_API.lower() == "true"
+        self.PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN") or config.get(USER_CFG_SECTION, "profile_token")
 
         self.DB_URI = os.environ.get("DB_URI") or config.get(USER_CFG_SECTION, "db_uri")
 
@@ -1,34 +1,61 @@
 #!python3
-import time
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
 
 from .binance_api_manager import BinanceAPIManager
-from .config import Config
+from .binance_stream_manager import MARKET_STREAMS, BinanceCache, BinanceStreamManager, TickerCache
+from .config import CFG_FL_NAME, COIN_LIST_FL_NAME, Config
 from .database import Database
+from .instrumentation import TickProfiler, instrumentation, log_instrumentation
 from .logger import Logger
 from .scheduler import SafeScheduler
 from .strategies import get_strategy
 from .stats import log_progress
 
-def main():
-    config = Config()
 
-    logger = Logger(config)
-    logger.info("Starting")
+def register_gauges(name: str, manager: BinanceAPIManager, db: Database):
+    """
+    Export the queue depths and cache sizes of a bot, labelled with its name
+    """
+    cache = manager.cache
+    stream_manager = manager.stream_manager
+    instrumentation.gauge("stream_queue_depth", stream_manager.events.qsize, bot=name)
+    instrumentation.gauge("pending_orders", lambda: len(stream_manager.pending_orders), bot=name)
+    instrumentation.gauge("ticker_cache_size", lambda: len(cache.ticker_values), bot=name)
+    instrumentation.gauge("order_cache_size", lambda: len(cache.orders), bot=name)
+    instrumentation.gauge("non_existent_ticker_cache_size", cache.tickers.non_existent_count, bot=name)
+    instrumentation.gauge(
+        "scout_history_queue_depth", lambda: db.scout_writer.queue_depth if db.scout_writer else 0, bot=name
+    )
+    instrumentation.gauge("scout_history_dropped", lambda: db.scout_writer.dropped if db.scout_writer else 0, bot=name)
 
 
+def setup_bot(
+    config: Config, logger: Logger, tickers: TickerCache = None, name="crypto_trading"
+) -> Optional[Tuple[SafeScheduler, BinanceAPIManager, Database]]:  # pylint: disable=unsubscriptable-object
+    """
+    Create the database, Binance manager and strategy of a bot, and schedule its jobs
+
+    :param tickers: Ticker prices shared with other bots, see BinanceAPIManager
+    :param name: Name of the bot in the exported metrics
+    :return: The scheduler, manager and database of the bot, None if it can't run
+    """
     db = Database(logger, config)
-    manager = BinanceAPIManager(config, db, logger)
+    manager = BinanceAPIManager(config, db, logger, tickers)
     # check if we can access API feature that require valid config
     try:
         _ = manager.get_account()
     except Exception as e:  # pylint: disable=broad-except
         logger.error("Couldn't access Binance API - API keys may be wrong or lack sufficient permissions")
         logger.error(e)
-        return
+        manager.close()
+        return None
     strategy = get_strategy(config.STRATEGY)
     if strategy is None:
         logger.error("Invalid strategy name")
-        return
+        manager.close()
+        return None
     trader = strategy(manager, db, logger, config)
     logger.debug(f"Chosen strategy: {config.STRATEGY}")
     logger.debug(f"Enable API: {config.ENABLE_API}")
@@ -42,21 +69,119 @@ def main():
     logger.debug("Creating database schema if it doesn't already exist")
     db.create_database()
     db.set_coins(config.SUPPORTED_COIN_LIST)
+    db.load_state()
+    manager.watch_tickers(db.get_coins(only_enabled=False))
 
     trader.initialize()
 
+    # Scouts can be profiled on demand through the API server
+    profiler = TickProfiler(logger, "scout")
+    db.socketio_client.on("profile", lambda data: profiler.request(int(data["ticks"])), namespace="/backend")
+
+    def scout_tick():
+        # Every price read during the tick, fees included, comes from the same ticker update
+        with manager.price_snapshot():
+            trader.scout()
+
+    scout = profiler.wrap(instrumentation.timed("AutoTrader.scout")(scout_tick))
+
     schedule = SafeScheduler(logger)
-    schedule.every(config.SCOUT_SLEEP_TIME).seconds.do(trader.scout).tag("scouting")
+    schedule.every(config.SCOUT_SLEEP_TIME).seconds.do(scout).tag("scouting")
     schedule.every(1).minutes.do(trader.update_values).tag("updating value history")
     schedule.every(1).minutes.do(db.prune_scout_history).tag("pruning scout history")
     schedule.every(1).hours.do(db.prune_value_history).tag("pruning value history")
+    schedule.every(manager.symbol_filters.ttl).seconds.do(manager.symbol_filters.refresh_in_background).tag(
+        "refreshing symbol filters"
+    )
     schedule.every(config.LOG_PROGRESS_AFTER_HOURS).hours.do(log_progress, db=db, logger=logger).tag(
         "logging progress"
     )
+    schedule.every(config.LOG_PROGRESS_AFTER_HOURS).hours.do(log_instrumentation, logger=logger).tag(
+        "logging timings"
+    )
+    schedule.every(10).seconds.do(db.send_instrumentation).tag("sending metrics")
+    register_gauges(name, manager, db)
+    return schedule, manager, db
 
+
+def run_schedule(schedule: SafeScheduler, stop: threading.Event):
+    while not stop.is_set():
+        schedule.run_pending()
+        stop.wait(1)
+
+
+def main():
+    config = Config()
+
+    logger = Logger(config)
+    logger.info("Starting")
+
+    bot = setup_bot(config, logger)
+    if bot is None:
+        return
+    schedule, manager, db = bot
+
+    try:
+        run_schedule(schedule, threading.Event())
+    finally:
+        manager.close()
+        db.close()
+
+
+def run_bots(bot_dirs: List[str]):
+    """
+    Run several bots in one process. Every directory holds the user.cfg (and optionally supported_coin_list) of
+    one bot, which gets its own database, user data stream and scheduler thread. Bots on the same exchange share a
+    single market data stream and ticker cache.
+    """
+    configs = {
+        os.path.basename(os.path.normpath(bot_dir)): Config(
+            os.path.join(bot_dir, CFG_FL_NAME), os.path.join(bot_dir, COIN_LIST_FL_NAME)
+        )
+        for bot_dir in bot_dirs
+    }
+    loggers = {name: Logger(config, name) for name, config in configs.items()}
+    logger = Logger(next(iter(configs.values())), "bots", enable_notifications=False)
+
+    db_uris = [config.DB_URI for config in configs.values()]
+    if len(set(db_uris)) != len(db_uris):
+        logger.error("Every bot needs its own database, check the db_uri of each user.cfg")
+        return
+
+    # One market data stream per exchange
+    market_streams: Dict[str, BinanceStreamManager] = {}
+    for config in configs.values():
+        if config.BINANCE_TLD not in market_streams:
+            market_streams[config.BINANCE_TLD] = BinanceStreamManager(
+                BinanceCache(), config, None, logger, MARKET_STREAMS
+            )
+            market_events = market_streams[config.BINANCE_TLD].events
+            instrumentation.gauge("stream_queue_depth", market_events.qsize, bot=f"market.{config.BINANCE_TLD}")
+
+    bots = []
+    stop = threading.Event()
     try:
-        while True:
-            schedule.run_pending()
-            time.sleep(1)
+        for name, config in configs.items():
+            loggers[name].info("Starting")
+            bot = setup_bot(config, loggers[name], market_streams[config.BINANCE_TLD].cache.tickers, name)
+            if bot is None:
+                loggers[name].error("Not starting this bot")
+                continue
+            schedule, manager, db = bot
+            thread = threading.Thread(target=run_schedule, args=(schedule, stop), name=name, daemon=True)
+            bots.append((thread, manager, db))
+            thread.start()
+
+        logger.info(f"Running {len(bots)} bots")
+        while any(thread.is_alive() for thread, _, _ in bots):
+            for thread, _, _ in bots:
+                thread.join(1)
     finally:
-        manager.stream_manager.close()
+        stop.set()
+        for thread, manager, db in bots:
+            # A bot may be waiting on an order, don't hang on it forever
+            thread.join(10)
+            manager.close()
+            db.close()
+        for stream_manager in market_streams.values():
+            stream_manager.close()
@@ -3,19 +3,32 @@ import os
 import time
 from contextlib import contextmanager
 from datetime import datetime, timedelta
-from typing import List, Optional, Union
+from typing import Dict, List, Optional, Union
 
 from socketio import Client
 from socketio.exceptions import ConnectionError as SocketIOConnectionError
 
-from sqlalchemy import create_engine, func, select, update
+from sqlalchemy import case, cast, create_engine, func, insert, inspect, or_, select, text, update
 from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import Session, scoped_session, sessionmaker
 from sqlalchemy.sql.expression import ColumnClause
 
 from .config import Config
+from .instrumentation import instrumentation, timed
 from .logger import Logger
 from .models import *  # pylint: disable=wildcard-import
+from .repository import Repository
+from .scout_history_writer import ScoutHistoryWriter
+
+
+# Rows deleted per transaction when pruning
+PRUNE_BATCH_SIZE = 1000
+# How long the values of each tier are kept, weekly ones are kept forever
+VALUE_HISTORY_RETENTION = {
+    Interval.MINUTELY: timedelta(hours=24),
+    Interval.HOURLY: timedelta(days=28),
+    Interval.DAILY: timedelta(days=365),
+}
 
 
 class IfDialect(ColumnClause):
@@ -53,6 +66,10 @@ class Database:
         self.engine = create_engine(config.DB_URI, **engine_args)
         self.session_factory = sessionmaker(bind=self.engine)
         self.scoped_session_factory = scoped_session(self.session_factory)
+        # Only used once load_state() was called, other processes sharing the database keep reading it directly
+        self.repository = Repository()
+        # Started on first use, so that processes which never scout don't get a writer thread
+        self.scout_writer: Optional[ScoutHistoryWriter] = None
 
     def socketio_connect(self):
         if not self.config.ENABLE_API:
@@ -74,42 +91,65 @@ class Database:
         Creates a context with an open SQLAlchemy session.
         """
         session: Session = self.scoped_session_factory()
-        yield session
-        session.commit()
-        session.close()
+        try:
+            with instrumentation.timer("Database.db_session"):
+                yield session
+                session.commit()
+        finally:
+            # Also when the body raises, such as a streamed response the client stopped reading
+            session.close()
+
+    def load_state(self):
+        """
+        Load coins, pairs and the current coin in memory. From then on they are read from memory only, so this
+        process must be the only one changing them.
+        """
+        session: Session
+        with self.db_session() as session:
+            self.repository.load(session)
 
     def set_coins(self, symbols: List[str]):
         session: Session
 
-        # Add coins to the database and set them as enabled or not
         with self.db_session() as session:
             # For all the coins in the database, if the symbol no longer appears
             # in the config file, set the coin as disabled
-            coins: List[Coin] = session.query(Coin).all()
-            for coin in coins:
-                if coin.symbol not in symbols:
-                    coin.enabled = False
+            session.execute(
+                update(Coin).values(enabled=Coin.symbol.in_(symbols)).execution_options(synchronize_session=False)
+            )
 
             # For all the symbols in the config file, add them to the database
             # if they don't exist
-            for symbol in symbols:
-                coin = next((coin for coin in coins if coin.symbol == symbol), None)
-                if coin is None:
-                    session.add(Coin(symbol))
-                else:
-                    coin.enabled = True
-
-        # For all the combinations of coins in the database, add a pair to the database
-        with self.db_session() as session:
-            coins: List[Coin] = session.query(Coin).filter(Coin.enabled).all()
-            for from_coin in coins:
-                for to_coin in coins:
-                    if from_coin != to_coin:
-                        pair = session.query(Pair).filter(Pair.from_coin == from_coin, Pair.to_coin == to_coin).first()
-                        if pair is None:
-                            session.add(Pair(from_coin, to_coin))
+            existing_coins = {symbol for symbol, in session.query(Coin.symbol)}
+            new_coins = [symbol for symbol in dict.fromkeys(symbols) if symbol not in existing_coins]
+            if new_coins:
+                session.execute(Coin.__table__.insert(), [{"symbol": symbol, "enabled": True} for symbol in new_coins])
+
+            # For all the combinations of enabled coins, add a pair to the database if it doesn't exist
+            enabled_coins = [symbol for symbol, in session.query(Coin.symbol).filter(Coin.enabled)]
+            existing_pairs = set(session.query(Pair.from_coin_id, Pair.to_coin_id))
+            new_pairs = [
+                {"from_coin_id": from_coin, "to_coin_id": to_coin, "enabled": True}
+                for from_coin in enabled_coins
+                for to_coin in enabled_coins
+                if from_coin != to_coin and (from_coin, to_coin) not in existing_pairs
+            ]
+            if new_pairs:
+                session.execute(Pair.__table__.insert(), new_pairs)
+
+            # A pair is enabled when both of its coins are
+            session.execute(
+                update(Pair)
+                .values(enabled=Pair.from_coin_id.in_(symbols) & Pair.to_coin_id.in_(symbols))
+                .execution_options(synchronize_session=False)
+            )
+
+        if self.repository.loaded:
+            self.load_state()
 
     def get_coins(self, only_enabled=True) -> List[Coin]:
+        if self.repository.loaded:
+            return self.repository.get_coins(only_enabled)
         session: Session
         with self.db_session() as session:
             if only_enabled:
@@ -122,6 +162,8 @@ class Database:
     def get_coin(self, coin: Union[Coin, str]) -> Coin:
         if isinstance(coin, Coin):
             return coin
+        if self.repository.loaded:
+            return self.repository.get_coin(coin)
         session: Session
         with self.db_session() as session:
             coin = session.query(Coin).get(coin)
@@ -137,8 +179,12 @@ class Database:
             cc = CurrentCoin(coin)
             session.add(cc)
             self.send_update(cc)
+            if self.repository.loaded:
+                self.repository.set_current_coin(coin.symbol, cc.datetime)
 
     def get_current_coin(self) -> Optional[Coin]:
+        if self.repository.loaded:
+            return self.repository.current_coin
         session: Session
         with self.db_session() as session:
             current_coin = session.query(CurrentCoin).order_by(CurrentCoin.datetime.desc()).first()
@@ -149,6 +195,8 @@ class Database:
             return coin
 
     def get_current_coin_date(self) -> Optional[datetime]:
+        if self.repository.loaded:
+            return self.repository.current_coin_date or datetime.now()
         session: Session
         with self.db_session() as session:
             current_coin = session.query(CurrentCoin).order_by(CurrentCoin.datetime.desc()).first()
@@ -160,6 +208,8 @@ class Database:
     def get_pair(self, from_coin: Union[Coin, str], to_coin: Union[Coin, str]):
         from_coin = self.get_coin(from_coin)
         to_coin = self.get_coin(to_coin)
+        if self.repository.loaded:
+            return self.repository.get_pair(from_coin.symbol, to_coin.symbol)
         session: Session
         with self.db_session() as session:
             pair: Pair = session.query(Pair).filter(Pair.from_coin == from_coin, Pair.to_coin == to_coin).first()
@@ -168,6 +218,8 @@ class Database:
 
     def get_pairs_from(self, from_coin: Union[Coin, str], only_enabled=True) -> List[Pair]:
         from_coin = self.get_coin(from_coin)
+        if self.repository.loaded:
+            return self.repository.get_pairs(only_enabled, from_symbol=from_coin.symbol)
         session: Session
         with self.db_session() as session:
             pairs = session.query(Pair).filter(Pair.from_coin == from_coin)
@@ -177,7 +229,22 @@ class Database:
             session.expunge_all()
             return pairs
 
+    def get_pairs_to(self, to_coin: Union[Coin, str], only_enabled=True) -> List[Pair]:
+        to_coin = self.get_coin(to_coin)
+        if self.repository.loaded:
+            return self.repository.get_pairs(only_enabled, to_symbol=to_coin.symbol)
+        session: Session
+        with self.db_session() as session:
+            pairs = session.query(Pair).filter(Pair.to_coin == to_coin)
+            if only_enabled:
+                pairs = pairs.filter(Pair.enabled.is_(True))
+            pairs = pairs.all()
+            session.expunge_all()
+            return pairs
+
     def get_pairs(self, only_enabled=True) -> List[Pair]:
+        if self.repository.loaded:
+            return self.repository.get_pairs(only_enabled)
         session: Session
         with self.db_session() as session:
             pairs = session.query(Pair)
@@ -187,6 +254,17 @@ class Database:
             session.expunge_all()
             return pairs
 
+    def set_ratios(self, pairs: List[Pair]):
+        """
+        Write the ratios of the given pairs in one batch. Pairs are updated in place, so that the in-memory
+        state (or whatever else holds them) already sees the new ratios.
+        """
+        if not pairs:
+            return
+        session: Session
+        with self.db_session() as session:
+            session.bulk_update_mappings(Pair, [{"id": pair.id, "ratio": pair.ratio} for pair in pairs])
+
     def log_scout(
         self,
         pair: Pair,
@@ -194,90 +272,153 @@ class Database:
         current_coin_price: float,
         other_coin_price: float,
     ):
-        session: Session
-        with self.db_session() as session:
-            pair = session.merge(pair)
-            sh = ScoutHistory(pair, target_ratio, current_coin_price, other_coin_price)
-            session.add(sh)
-            self.send_update(sh)
+        self.log_scouts([pair], [target_ratio], current_coin_price, [other_coin_price])
+
+    @timed()
+    def log_scouts(
+        self,
+        pairs: List[Pair],
+        target_ratios: List[float],
+        current_coin_price: float,
+        other_coin_prices: List[float],
+    ):
+        """
+        Queue the scout history of every pair evaluated by one scout at once
+        """
+        if self.scout_writer is None:
+            self.scout_writer = ScoutHistoryWriter(self, self.logger, ring_size=self.config.SCOUT_HISTORY_RING_SIZE)
+        now = datetime.utcnow()
+        self.scout_writer.put_many(
+            [
+                (pair, target_ratio, current_coin_price, other_coin_price, now)
+                for pair, target_ratio, other_coin_price in zip(pairs, target_ratios, other_coin_prices)
+            ]
+        )
 
     def prune_scout_history(self):
+        if self.config.SCOUT_HISTORY_RING_SIZE:
+            # The ring buffer overwrites its oldest rows, only those written before it was enabled are left
+            self._delete_in_batches(ScoutHistory, ScoutHistory.id > self.config.SCOUT_HISTORY_RING_SIZE)
+            return
         time_diff = datetime.now() - timedelta(hours=self.config.SCOUT_HISTORY_PRUNE_TIME)
-        session: Session
-        with self.db_session() as session:
-            session.query(ScoutHistory).filter(ScoutHistory.datetime < time_diff).delete()
+        self._delete_in_batches(ScoutHistory, ScoutHistory.datetime < time_diff)
 
     def prune_value_history(self):
-        def _datetime_id_query(default, sqlite):
-            dt_column = if_dialect(
-                default=func.to_char(CoinValue.datetime, default),
-                sqlite=func.strftime(sqlite, CoinValue.datetime),
-            )
-
-            grouped = select(
-                CoinValue, func.max(CoinValue.datetime), dt_column
-            ).group_by(CoinValue.coin_id, CoinValue, dt_column)
-
-            return select(grouped.c.id.label("id")).select_from(grouped)
+        """
+        Delete the coin and portfolio values older than the retention of their tier. Values are tiered when written
+        (see Interval.of), so only the expired rows are looked at, through the (interval, datetime) indexes.
+        """
+        # The last 24 hours of minutely entries are kept, so count(coins) * 1440 entries, the last 28 days of hourly
+        # ones, the last year of daily ones and all weekly ones.
+        now = datetime.now()
+        for model in (CoinValue, PortfolioValue):
+            for interval, retention in VALUE_HISTORY_RETENTION.items():
+                self._delete_in_batches(model, model.interval == interval, model.datetime < now - retention)
+
+    def _delete_in_batches(self, model, *criteria) -> int:
+        """
+        Delete matching rows PRUNE_BATCH_SIZE at a time, each batch in its own transaction, so that writers (and
+        the SQLite write lock) never wait long behind a prune
+        """
+        deleted = 0
+        while True:
+            session: Session
+            with self.db_session() as session:
+                batch = select(model.id).where(*criteria).limit(PRUNE_BATCH_SIZE)
+                count = session.query(model).filter(model.id.in_(batch)).delete(synchronize_session=False)
+            deleted += count
+            if count < PRUNE_BATCH_SIZE:
+                return deleted
+
+    def close(self):
+        """
+        Write the scout history that is still queued
+        """
+        if self.scout_writer is not None:
+            self.scout_writer.close()
+            self.scout_writer = None
 
-        def _update_query(datetime_query, interval):
-            return (
-                update(CoinValue)
-                .where(CoinValue.id.in_(datetime_query))
-                .values(interval=interval)
-                .execution_options(synchronize_session="fetch")
-            )
+    def create_database(self):
+        Base.metadata.create_all(self.engine)
+        self.migrate()
 
-        hourly_update_query = _update_query(
-            _datetime_id_query(default="HH24", sqlite="%H"), Interval.HOURLY
-        )
-        weekly_update_query = _update_query(
-            _datetime_id_query(default="YYYY-WW", sqlite="%Y-%W"),
-            Interval.WEEKLY,
+    def migrate(self):
+        """
+        Bring the schema of a database created by an older version up to date. create_all() only creates missing
+        tables, so columns and indexes added to existing tables are created here.
+        """
+        with self.engine.begin() as connection:
+            pair_columns = {column["name"] for column in inspect(connection).get_columns(Pair.__tablename__)}
+            if "enabled" not in pair_columns:
+                self.logger.info("Adding the enabled column to pairs")
+                column_type = Pair.__table__.c.enabled.type.compile(dialect=connection.dialect)
+                connection.execute(text(f"ALTER TABLE {Pair.__tablename__} ADD COLUMN enabled {column_type}"))
+                connection.execute(
+                    update(Pair).values(
+                        enabled=select(func.count(Coin.symbol) == 2)
+                        .where(or_(Coin.symbol == Pair.from_coin_id, Coin.symbol == Pair.to_coin_id))
+                        .where(Coin.enabled.is_(True))
+                        .scalar_subquery()
+                    )
+                )
+
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    index.create(connection, checkfirst=True)
+
+            if connection.dialect.name == "postgresql" and not self.config.SCOUT_HISTORY_RING_SIZE:
+                # The ring buffer writes explicit ids, which don't advance the id sequence, so catch it up once the
+                # ring buffer is turned off
+                connection.execute(
+                    text(
+                        f"SELECT setval(pg_get_serial_sequence('{ScoutHistory.__tablename__}', 'id'), "
+                        f"COALESCE(MAX(id), 0) + 1, false) FROM {ScoutHistory.__tablename__}"
+                    )
+                )
+
+            if connection.execute(select(PortfolioValue.id).limit(1)).first() is None:
+                self._tier_coin_values(connection)
+
+                # Sum the value history written before the portfolio values were, in the coarsest tier of the
+                # summed values. Tiers are ranked explicitly since MAX() over an enum compares the names on SQLite
+                # but the declaration order on PostgreSQL.
+                tiers = list(Interval)
+                rank = case(*[(CoinValue.interval == interval, rank) for rank, interval in enumerate(tiers)])
+                coarsest = case({rank: interval.name for rank, interval in enumerate(tiers)}, value=func.max(rank))
+                totals = select(
+                    CoinValue.datetime,
+                    func.sum(CoinValue.usd_value),
+                    func.sum(CoinValue.btc_value),
+                    cast(coarsest, PortfolioValue.interval.type),
+                ).group_by(CoinValue.datetime)
+                result = connection.execute(
+                    insert(PortfolioValue).from_select(["datetime", "usd_value", "btc_value", "interval"], totals)
+                )
+                if result.rowcount:
+                    self.logger.info(f"Added {result.rowcount} portfolio values from the value history")
+
+    def _tier_coin_values(self, connection):
+        """
+        Older versions only tiered the coin values in the hourly prune, so those written since its last run are
+        still MINUTELY (or NULL). Tier them like update_values does, before they get pruned or summed.
+        """
+        previous = func.lag(CoinValue.datetime, type_=CoinValue.datetime.type).over(
+            partition_by=CoinValue.coin_id, order_by=CoinValue.datetime
         )
-        daily_update_query = _update_query(
-            _datetime_id_query(default="YYYY-DDD", sqlite="%Y-%j"),
-            Interval.DAILY,
+        values = select(CoinValue.id, CoinValue.interval, CoinValue.datetime, previous.label("previous")).subquery()
+        untiered = select(values.c.id, values.c.datetime, values.c.previous).where(
+            or_(values.c.interval == Interval.MINUTELY, values.c.interval.is_(None))
         )
+        tiers: Dict[Interval, List[int]] = {}
+        for row in connection.execute(untiered):
+            tiers.setdefault(Interval.of(row.previous, row.datetime), []).append(row.id)
 
-        session: Session
-        with self.db_session() as session:
-            # Sets the first entry for each coin for each hour as 'hourly'
-            session.execute(hourly_update_query)
-
-            # Sets the first entry for each coin for each day as 'daily'
-            session.execute(daily_update_query)
-
-            # Sets the first entry for each coin for each month as 'weekly'
-            # (Sunday is the start of the week)
-            session.execute(weekly_update_query)
-
-            # Early commit to make sure the delete statements work properly.
-            session.commit()
-
-            # The last 24 hours worth of minutely entries will be kept, so
-            # count(coins) * 1440 entries
-            time_diff = datetime.now() - timedelta(hours=24)
-            session.query(CoinValue).filter(
-                CoinValue.interval == Interval.MINUTELY, CoinValue.datetime < time_diff
-            ).delete()
-
-            # The last 28 days worth of hourly entries will be kept, so count(coins) * 672 entries
-            time_diff = datetime.now() - timedelta(days=28)
-            session.query(CoinValue).filter(
-                CoinValue.interval == Interval.HOURLY, CoinValue.datetime < time_diff
-            ).delete()
-
-            # The last years worth of daily entries will be kept, so count(coins) * 365 entries
-            time_diff = datetime.now() - timedelta(days=365)
-            session.query(CoinValue).filter(
-                CoinValue.interval == Interval.DAILY, CoinValue.datetime < time_diff
-            ).delete()
-
-            # All weekly entries will be kept forever
-
-    def create_database(self):
-        Base.metadata.create_all(self.engine)
+        for interval, ids in tiers.items():
+            for start in range(0, len(ids), PRUNE_BATCH_SIZE):
+                batch = ids[start : start + PRUNE_BATCH_SIZE]
+                connection.execute(update(CoinValue).where(CoinValue.id.in_(batch)).values(interval=interval))
+        if tiers:
+            self.logger.info(f"Tiered {sum(len(ids) for ids in tiers.values())} coin values from the value history")
 
     def start_trade_log(self, from_coin: Coin, to_coin: Coin, selling: bool):
         return TradeLog(self, from_coin, to_coin, selling)
@@ -292,6 +433,12 @@ class Database:
             namespace="/backend",
         )
 
+    def send_instrumentation(self):
+        if not self.socketio_connect():
+            return
+
+        self.socketio_client.emit("instrumentation", instrumentation.snapshot(), namespace="/backend")
+
 class TradeLog:
     def __init__(self, db: Database, from_coin: Coin, to_coin: Coin, selling: bool):
         self.db = db
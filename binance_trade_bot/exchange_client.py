@@ -0,0 +1,138 @@
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from binance.client import Client
+from requests.adapters import HTTPAdapter
+
+# Request weight of the endpoints the bot uses, by last path segment. Anything else weighs 1.
+REQUEST_WEIGHTS = {
+    "account": 10,
+    "exchangeInfo": 10,
+    "price": 2,  # every ticker at once
+    "order": 2,
+    "openOrders": 3,
+    "allOrders": 10,
+    "myTrades": 10,
+}
+# Header in which Binance reports the weight used by this IP in the current minute
+USED_WEIGHT_HEADER = "X-MBX-USED-WEIGHT-1M"
+
+
+def request_weight(uri: str) -> int:
+    return REQUEST_WEIGHTS.get(uri.split("?", 1)[0].rsplit("/", 1)[-1], 1)
+
+
+class RateLimiter:
+    """
+    Token bucket of request weight shared by all fetching threads, refilled continuously up to the budget per minute
+    """
+
+    def __init__(self, weight_per_minute: int):
+        self.capacity = weight_per_minute
+        self.tokens = float(weight_per_minute)
+        self.rate = weight_per_minute / 60
+        self.updated = time.monotonic()
+        self.mutex = threading.Lock()
+
+    def acquire(self, weight: int):
+        while True:
+            with self.mutex:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= weight:
+                    self.tokens -= weight
+                    return
+                wait = (weight - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def observe(self, used_weight: int):
+        """
+        Take the weight Binance says was used this minute into account, it includes requests made by other clients
+        """
+        with self.mutex:
+            self.tokens = min(self.tokens, self.capacity - used_weight)
+
+    def pause(self, seconds: float):
+        """
+        Drain the bucket, used when Binance tells us we're going too fast anyway
+        """
+        with self.mutex:
+            self.tokens = -seconds * self.rate
+
+
+class ExchangeClient(Client):
+    """
+    Binance client that can be shared by several threads.
+
+    Requests go through a pool of keep-alive connections and wait for the request weight budget, which follows the
+    usage Binance reports. Independent requests can be run concurrently with `submit`.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        api_secret: str,
+        tld="com",
+        base_url: Optional[str] = None,  # pylint: disable=unsubscriptable-object
+        workers=4,
+        weight_per_minute=1000,
+    ):
+        """
+        :param base_url: Exchange to talk to instead of Binance, e.g. a local mock exchange in tests
+        """
+        if base_url is not None:
+            self.API_URL = base_url + "/api"
+            self.MARGIN_API_URL = base_url + "/sapi"
+            self.WITHDRAW_API_URL = base_url + "/wapi"
+        self.workers = workers
+        self.limiter = RateLimiter(weight_per_minute)
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="binance-rest")
+        super().__init__(api_key, api_secret, tld=tld)
+
+    def _init_session(self):
+        session = super()._init_session()
+        # One connection per worker plus the calling thread, kept alive between requests
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.workers + 1)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    # The base client keeps the last response in an attribute, make it per thread
+    @property
+    def response(self):
+        return getattr(self._local, "response", None)
+
+    @response.setter
+    def response(self, response):
+        self._local.response = response
+
+    def _request(self, method, uri, signed, force_params=False, **kwargs):
+        self.limiter.acquire(request_weight(uri))
+        self.response = None
+        try:
+            return super()._request(method, uri, signed, force_params, **kwargs)
+        finally:
+            self._account(self.response)
+
+    def _account(self, response):
+        if response is None:
+            return
+        used_weight = response.headers.get(USED_WEIGHT_HEADER)
+        if used_weight is not None:
+            self.limiter.observe(int(used_weight))
+        if response.status_code in (418, 429):
+            self.limiter.pause(int(response.headers.get("Retry-After", 60)))
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Run a call in the background, typically a client method
+        """
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        self.session.close()
@@ -0,0 +1,327 @@
+import cProfile
+import functools
+import io
+import os
+import pstats
+import re
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Callable, Dict, List, Tuple
+
+from .logger import Logger
+
+# Upper bounds of the histogram buckets in seconds, doubling from 1us to about 2 minutes
+BUCKETS = tuple(1e-6 * 2 ** i for i in range(28))
+# Prefix of the exported metric names
+METRICS_PREFIX = "binance_trade_bot"
+
+
+class Histogram:
+    """
+    Durations bucketed on a log scale, so recording one is a bisect and an increment
+    """
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds: float):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: "Histogram"):
+        for bucket, count in enumerate(other.counts):
+            self.counts[bucket] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float) -> float:
+        """
+        Upper bound of the bucket holding the given percentile, capped by the longest duration seen
+        """
+        rank = self.count * percent / 100
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                return min(BUCKETS[bucket], self.max) if bucket < len(BUCKETS) else self.max
+        return self.max
+
+    def summary(self) -> Dict[str, float]:
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "max": self.max,
+        }
+
+
+class _ShardOwner:  # pylint: disable=too-few-public-methods
+    """
+    Kept in the thread local storage of a thread, so that it is collected when the thread ends
+    """
+
+    __slots__ = ("__weakref__",)
+
+
+def _fold(into: Tuple[Dict[str, Histogram], Dict[str, float]], shard: Tuple[Dict[str, Histogram], Dict[str, float]]):
+    histograms, counters = into
+    for name, histogram in list(shard[0].items()):
+        histograms.setdefault(name, Histogram()).merge(histogram)
+    for name, value in list(shard[1].items()):
+        counters[name] = counters.get(name, 0) + value
+
+
+class Instrumentation:
+    """
+    Timers, counters and gauges of the bot, shared by everything running in the process.
+
+    Every thread records into its own shard, so recording never takes a lock. Shards are merged when read, and
+    folded into a base shard when their thread ends. Gauges are callbacks, only evaluated when a snapshot is taken.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.started = datetime.now()
+        self._local = threading.local()
+        # (histograms, counters) of the threads that ended, then of every live thread that recorded something
+        self._base: Tuple[Dict[str, Histogram], Dict[str, float]] = ({}, {})
+        self._shards: List[Tuple[Dict[str, Histogram], Dict[str, float]]] = []
+        self._gauges: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], Callable[[], float]] = {}
+        # Only taken when a thread records for the first time or ends, and by readers. Reentrant since a garbage
+        # collection while holding it can end another thread's shard.
+        self._mutex = threading.RLock()
+
+    def _shard(self) -> Tuple[Dict[str, Histogram], Dict[str, float]]:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = ({}, {})
+            owner = self._local.owner = _ShardOwner()
+            weakref.finalize(owner, self._retire, shard)
+            with self._mutex:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def _retire(self, shard: Tuple[Dict[str, Histogram], Dict[str, float]]):
+        with self._mutex:
+            self._shards = [other for other in self._shards if other is not shard]
+            _fold(self._base, shard)
+
+    def record(self, name: str, seconds: float):
+        if not self.enabled:
+            return
+        histograms = self._shard()[0]
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(seconds)
+
+    def count(self, name: str, value: float = 1):
+        if not self.enabled:
+            return
+        counters = self._shard()[1]
+        counters[name] = counters.get(name, 0) + value
+
+    def gauge(self, name: str, fn: Callable[[], float], **labels: str):
+        """
+        Register a callback giving the current value of a gauge, replacing any previous one with the same labels
+        """
+        with self._mutex:
+            self._gauges[(name, tuple(sorted(labels.items())))] = fn
+
+    @contextmanager
+    def timer(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name: str = None):
+        """
+        Decorator recording the duration of every call, under the qualified name of the function by default
+        """
+
+        def decorator(fn: Callable):
+            label = name or fn.__qualname__
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.record(label, time.perf_counter() - start)
+
+            return wrapper
+
+        return decorator
+
+    def _merged(self) -> Tuple[Dict[str, Histogram], Dict[str, float]]:
+        merged: Tuple[Dict[str, Histogram], Dict[str, float]] = ({}, {})
+        # Under the mutex, so that a shard being retired isn't counted twice
+        with self._mutex:
+            for shard in [self._base, *self._shards]:
+                _fold(merged, shard)
+        return merged
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {name: histogram.summary() for name, histogram in sorted(self._merged()[0].items())}
+
+    def snapshot(self) -> dict:
+        """
+        Everything recorded so far, in a form that can be sent as json
+        """
+        histograms, counters = self._merged()
+        with self._mutex:
+            gauges = list(self._gauges.items())
+        gauge_values = []
+        for (name, labels), fn in gauges:
+            try:
+                value = fn()
+            except Exception:  # pylint: disable=broad-except
+                continue
+            gauge_values.append({"name": name, "labels": dict(labels), "value": value})
+        return {
+            "started": self.started.isoformat(),
+            "timers": {
+                name: {**histogram.summary(), "buckets": histogram.counts}
+                for name, histogram in sorted(histograms.items())
+            },
+            "counters": dict(sorted(counters.items())),
+            "gauges": gauge_values,
+        }
+
+
+instrumentation = Instrumentation()
+timed = instrumentation.timed
+
+
+def log_instrumentation(logger: Logger):
+    summary = instrumentation.summary()
+    if not summary:
+        return
+    width = max(len(name) for name in summary)
+    header = " | ".join(
+        [f"{'Timer':<{width}}", f"{'Count':>9}", f"{'Mean ms':>9}", f"{'p50 ms':>9}", f"{'p95 ms':>9}"]
+        + [f"{'p99 ms':>9}", f"{'Max ms':>9}", f"{'Total s':>9}"]
+    )
+    rows = [
+        " | ".join(
+            [f"{name:<{width}}", f"{timer['count']:>9}"]
+            + [f"{timer[key] * 1000:>9.3f}" for key in ("mean", "p50", "p95", "p99", "max")]
+            + [f"{timer['total']:>9.1f}"]
+        )
+        for name, timer in summary.items()
+    ]
+    logger.info(
+        f"Timings since {instrumentation.started:%Y-%m-%d %H:%M}:\n"
+        + "\n".join([header, "-" * len(header), *rows])
+    )
+
+
+def _metric_name(name: str) -> str:
+    return f"{METRICS_PREFIX}_{re.sub(r'[^a-zA-Z0-9_]', '_', name)}"
+
+
+def _metric_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + "}"
+
+
+def prometheus_text(snapshot: dict) -> str:
+    """
+    Render a snapshot in the Prometheus text exposition format
+    """
+    duration = _metric_name("duration_seconds")
+    lines = [f"# HELP {duration} Time spent in the timed parts of the bot", f"# TYPE {duration} histogram"]
+    for name, timer in snapshot.get("timers", {}).items():
+        cumulative = 0
+        for bound, count in zip(BUCKETS, timer["buckets"]):
+            cumulative += count
+            lines.append(f"{duration}_bucket{_metric_labels({'timer': name, 'le': f'{bound:g}'})} {cumulative}")
+        lines.append(f"{duration}_bucket{_metric_labels({'timer': name, 'le': '+Inf'})} {timer['count']}")
+        lines.append(f"{duration}_sum{_metric_labels({'timer': name})} {timer['total']}")
+        lines.append(f"{duration}_count{_metric_labels({'timer': name})} {timer['count']}")
+
+    for name, value in snapshot.get("counters", {}).items():
+        metric = _metric_name(name) + "_total"
+        lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+
+    gauges: Dict[str, List[str]] = {}
+    for gauge in snapshot.get("gauges", []):
+        metric = _metric_name(gauge["name"])
+        gauges.setdefault(metric, []).append(f"{metric}{_metric_labels(gauge['labels'])} {gauge['value']}")
+    for metric, samples in gauges.items():
+        lines += [f"# TYPE {metric} gauge", *samples]
+    return "\n".join(lines) + "\n"
+
+
+class TickProfiler:
+    """
+    Runs cProfile over the next ticks of a job when asked to, then saves the profile and logs the hottest functions
+    """
+
+    def __init__(self, logger: Logger, name: str, directory="data/profiles", top=25):
+        self.logger = logger
+        self.name = name
+        self.directory = directory
+        self.top = top
+        self.ticks_left = 0
+        self._profile = None
+        self._mutex = threading.Lock()
+
+    def request(self, ticks: int):
+        with self._mutex:
+            self.ticks_left = ticks
+        self.logger.info(f"Profiling the next {ticks} ticks of {self.name}")
+
+    def wrap(self, fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not self.ticks_left:
+                return fn(*args, **kwargs)
+            if self._profile is None:
+                self._profile = cProfile.Profile()
+            self._profile.enable()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._profile.disable()
+                with self._mutex:
+                    self.ticks_left = max(self.ticks_left - 1, 0)
+                    done = not self.ticks_left
+                if done:
+                    self._report()
+
+        return wrapper
+
+    def _report(self):
+        profile, self._profile = self._profile, None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{self.name}_{datetime.now():%Y%m%d_%H%M%S}.prof")
+        profile.dump_stats(path)
+        output = io.StringIO()
+        pstats.Stats(profile, stream=output).sort_stats("cumulative").print_stats(self.top)
+        self.logger.info(f"Profile of {self.name} saved to {path}:\n{output.getvalue().strip()}")
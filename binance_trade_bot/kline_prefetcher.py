@@ -0,0 +1,188 @@
+import argparse
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Callable, List, Sequence, Tuple
+
+import numpy as np
+from binance.client import Client
+from binance.exceptions import BinanceAPIException
+
+from .config import Config
+from .exchange_client import ExchangeClient, RateLimiter
+from .kline_store import UNFETCHED, KlineStore
+from .logger import Logger
+
+# Binance returns at most this many klines per request
+WINDOW_MINUTES = 1000
+# Request weight of a klines request with limit=1000
+KLINES_WEIGHT = 2
+# Binance error codes
+INVALID_SYMBOL = -1121
+TOO_MANY_REQUESTS = -1003
+
+Window = Tuple[str, datetime, int]
+
+
+def _timestamp_ms(dt: datetime) -> int:
+    return (dt - datetime(1970, 1, 1)) // timedelta(milliseconds=1)
+
+
+def binance_client_factory(config: Config) -> Callable[[], Client]:
+    return lambda: ExchangeClient(
+        config.BINANCE_API_KEY, config.BINANCE_API_SECRET_KEY, tld=config.BINANCE_TLD, base_url=config.BINANCE_API_URL
+    )
+
+
+class KlinePrefetcher:
+    """
+    Fills the kline store with every minute missing for a set of symbols and a date range.
+
+    Missing minutes are planned as windows of up to 1000 klines, fetched concurrently under a request weight
+    budget and written to the store from the calling thread. The store is flushed regularly, so an interrupted
+    prefetch resumes from the windows that are still missing.
+    """
+
+    def __init__(
+        self,
+        store: KlineStore,
+        client_factory: Callable[[], Client],
+        logger: Logger,
+        workers=4,
+        weight_per_minute=1000,
+        retries=5,
+        flush_every=50,
+    ):
+        self.store = store
+        self.client_factory = client_factory
+        self.logger = logger
+        self.workers = workers
+        self.limiter = RateLimiter(weight_per_minute)
+        self.retries = retries
+        self.flush_every = flush_every
+        self._local = threading.local()
+
+    def plan(self, symbols: Sequence[str], start_date: datetime, end_date: datetime) -> List[Window]:
+        """
+        Windows of minutes in [start_date, end_date) that haven't been fetched yet, as (symbol, start, minutes)
+        """
+        start_date = start_date.replace(second=0, microsecond=0)
+        total = int((end_date - start_date) // timedelta(minutes=1))
+        windows = []
+        for symbol in symbols:
+            unfetched = np.flatnonzero(self.store.get_range(symbol, start_date, end_date) == UNFETCHED)
+            position = 0
+            while position < len(unfetched):
+                first = int(unfetched[position])
+                windows.append((symbol, start_date + timedelta(minutes=first), min(WINDOW_MINUTES, total - first)))
+                position = int(np.searchsorted(unfetched, first + WINDOW_MINUTES))
+        return windows
+
+    def _client(self) -> Client:
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = self._local.client = self.client_factory()
+        return client
+
+    def _fetch(self, window: Window):
+        symbol, start_date, minutes = window
+        start_ms = _timestamp_ms(start_date)
+        for attempt in range(self.retries):
+            self.limiter.acquire(KLINES_WEIGHT)
+            try:
+                return self._client().get_klines(
+                    symbol=symbol,
+                    interval="1m",
+                    startTime=start_ms,
+                    endTime=start_ms + minutes * 60000 - 1,
+                    limit=WINDOW_MINUTES,
+                )
+            except BinanceAPIException as e:
+                if e.code == INVALID_SYMBOL:
+                    return []
+                if e.code == TOO_MANY_REQUESTS or e.status_code in (418, 429):
+                    self.limiter.pause(60)
+                self.logger.warning(f"Failed to fetch {symbol} from {start_date} (attempt {attempt + 1}): {e}")
+            except Exception as e:  # pylint: disable=broad-except
+                self.logger.warning(f"Failed to fetch {symbol} from {start_date} (attempt {attempt + 1}): {e}")
+            if attempt + 1 < self.retries:
+                time.sleep(2 ** attempt)
+        return None
+
+    def _store(self, window: Window, klines):
+        symbol, start_date, minutes = window
+        # Minutes that aren't in the past yet can't be marked as missing
+        minutes = min(minutes, int((datetime.utcnow() - start_date) // timedelta(minutes=1)))
+        if minutes <= 0:
+            return
+        end_ms = _timestamp_ms(start_date) + minutes * 60000
+        self.store.put(symbol, start_date, [None] * minutes)
+        self.store.put_klines(symbol, (kline for kline in klines if int(kline[0]) < end_ms))
+
+    def prefetch(self, symbols: Sequence[str], start_date: datetime, end_date: datetime):
+        """
+        Fetch every missing minute of the given symbols between the two dates
+
+        :return: the number of windows that could not be fetched
+        """
+        windows = self.plan(symbols, start_date, end_date)
+        self.logger.info(f"Prefetching {len(windows)} windows of {WINDOW_MINUTES} minutes for {len(symbols)} symbols")
+
+        failed = 0
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        futures = {executor.submit(self._fetch, window): window for window in windows}
+        try:
+            for done, future in enumerate(as_completed(futures), 1):
+                window = futures[future]
+                klines = future.result()
+                if klines is None:
+                    self.logger.error(f"Giving up on {window[0]} from {window[1]}, it will be fetched on next run")
+                    failed += 1
+                else:
+                    self._store(window, klines)
+                if done % self.flush_every == 0:
+                    self.store.flush()
+                    self.logger.info(f"Prefetched {done}/{len(windows)} windows")
+        finally:
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+            self.store.flush()
+        return failed
+
+
+def main():
+    config = Config()
+    parser = argparse.ArgumentParser(description="Prefetch historical klines for backtesting")
+    parser.add_argument("--start", type=datetime.fromisoformat, default=datetime(2021, 1, 1))
+    parser.add_argument("--end", type=datetime.fromisoformat, default=datetime.utcnow())
+    parser.add_argument("--coins", default=" ".join(config.SUPPORTED_COIN_LIST), help="space separated coin list")
+    parser.add_argument("--bridge", default=config.BRIDGE.symbol)
+    parser.add_argument("--path", default="data/klines", help="kline store directory")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--weight-per-minute", type=int, default=1000)
+    args = parser.parse_args()
+
+    logger = Logger(config, "prefetcher", enable_notifications=False)
+    symbols = [coin + args.bridge for coin in args.coins.split()]
+    if "BTC" + args.bridge not in symbols:
+        symbols.append("BTC" + args.bridge)
+
+    store = KlineStore(args.path)
+    prefetcher = KlinePrefetcher(
+        store, binance_client_factory(config), logger, workers=args.workers, weight_per_minute=args.weight_per_minute
+    )
+    try:
+        failed = prefetcher.prefetch(symbols, args.start, args.end)
+    except KeyboardInterrupt:
+        logger.info("Interrupted, run again to resume")
+        return
+    finally:
+        store.close()
+    if failed:
+        logger.warning(f"{failed} windows could not be fetched, run again to retry them")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,231 @@
+import argparse
+import csv
+import json
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Optional, Sequence
+
+import numpy as np
+
+# Minute zero of every symbol file, Binance has no kline data before this
+EPOCH = datetime(2017, 1, 1)
+EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds()) * 1000
+# Files are grown in chunks of this many minutes (~45 days) to avoid remapping on every write
+GROW_MINUTES = 2 ** 16
+
+# A minute that was fetched but has no kline is stored as NaN, a minute that was never fetched is 0
+MISSING = np.nan
+UNFETCHED = 0.0
+
+
+def minute_offset(dt: datetime) -> int:
+    return int((dt - EPOCH) // timedelta(minutes=1))
+
+
+def minute_datetime(offset: int) -> datetime:
+    return EPOCH + timedelta(minutes=offset)
+
+
+class KlineStore:
+    """
+    Columnar price store used by backtesting.
+
+    Every symbol gets one file in `path` holding a flat array of prices, one per minute since EPOCH, which
+    is memory-mapped on first use. Looking up a price is then an index into the array rather than a query.
+    """
+
+    def __init__(self, path: str = "data/klines", dtype=np.float64, readonly=False):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.readonly = readonly
+        self._arrays: Dict[str, np.memmap] = {}
+        if not readonly:
+            os.makedirs(path, exist_ok=True)
+
+    def _file(self, symbol: str):
+        return os.path.join(self.path, f"{symbol}.{self.dtype.name}")
+
+    def symbols(self):
+        suffix = f".{self.dtype.name}"
+        if not os.path.isdir(self.path):
+            return []
+        return sorted(name[: -len(suffix)] for name in os.listdir(self.path) if name.endswith(suffix))
+
+    def _array(self, symbol: str, min_length: int = 0) -> Optional[np.memmap]:
+        array = self._arrays.get(symbol)
+        if array is not None and len(array) >= min_length:
+            return array
+
+        filename = self._file(symbol)
+        length = os.path.getsize(filename) // self.dtype.itemsize if os.path.exists(filename) else 0
+
+        if length < min_length:
+            if self.readonly:
+                raise PermissionError(f"Kline store at {self.path} is read-only")
+            if array is not None:
+                array.flush()
+            length = -(-min_length // GROW_MINUTES) * GROW_MINUTES
+            with open(filename, "ab") as fh:
+                fh.truncate(length * self.dtype.itemsize)
+
+        if length == 0:
+            return None
+
+        array = np.memmap(filename, dtype=self.dtype, mode="r" if self.readonly else "r+", shape=(length,))
+        self._arrays[symbol] = array
+        return array
+
+    def get(self, symbol: str, dt: datetime) -> Optional[float]:
+        """
+        Get the price of a symbol at the given minute, None if Binance has no kline for it.
+
+        Raises KeyError if that minute hasn't been fetched yet.
+        """
+        offset = minute_offset(dt)
+        if offset < 0:
+            return None
+
+        array = self._arrays.get(symbol)
+        if array is None or offset >= len(array):
+            # The file may have been grown by another store since it was mapped
+            self._arrays.pop(symbol, None)
+            array = self._array(symbol)
+        if array is None or offset >= len(array):
+            raise KeyError(f"{symbol} - {dt}")
+
+        price = array[offset]
+        if price == UNFETCHED:
+            raise KeyError(f"{symbol} - {dt}")
+        if price != price:  # NaN
+            return None
+        return float(price)
+
+    def get_range(self, symbol: str, start: datetime, end: datetime) -> np.ndarray:
+        """
+        Get the prices of a symbol for every minute in [start, end), as stored (NaN missing, 0 not fetched)
+        """
+        start_offset = max(minute_offset(start), 0)
+        end_offset = max(minute_offset(end), start_offset)
+        result = np.zeros(end_offset - start_offset, dtype=self.dtype)
+
+        array = self._array(symbol)
+        if array is not None:
+            available = array[start_offset:end_offset]
+            result[: len(available)] = available
+        return result
+
+    def put(self, symbol: str, start: datetime, prices: Sequence[Optional[float]]):
+        """
+        Store consecutive minutely prices of a symbol starting at `start`, None marks a minute without kline
+        """
+        start_offset = minute_offset(start)
+        values = np.array([MISSING if price is None else price for price in prices], dtype=self.dtype)
+        if start_offset < 0:
+            values = values[-start_offset:]
+            start_offset = 0
+        if len(values) == 0:
+            return
+        array = self._array(symbol, start_offset + len(values))
+        array[start_offset : start_offset + len(values)] = values
+
+    def put_klines(self, symbol: str, klines: Iterable[Sequence]):
+        """
+        Store klines in the Binance REST layout (open time in ms first, open price second)
+        """
+        klines = list(klines)
+        if not klines:
+            return
+        offsets = np.array([(int(kline[0]) - EPOCH_MS) // 60000 for kline in klines], dtype=np.int64)
+        values = np.array([float(kline[1]) for kline in klines], dtype=self.dtype)
+        keep = offsets >= 0
+        if not keep.any():
+            return
+        array = self._array(symbol, int(offsets.max()) + 1)
+        array[offsets[keep]] = values[keep]
+
+    def flush(self):
+        for array in self._arrays.values():
+            array.flush()
+
+    def close(self):
+        if not self.readonly:
+            self.flush()
+        self._arrays.clear()
+
+
+def import_sqlitedict_cache(store: KlineStore, filename: str = "data/backtest_cache.db"):
+    """
+    Import the prices of the SqliteDict backtest cache, keyed as "BTCUSDT - 2021-01-01 00:00:00"
+    """
+    from sqlitedict import SqliteDict  # pylint: disable=import-outside-toplevel
+
+    key_re = re.compile(r"^(\w+) - (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})$")
+    minutes: Dict[str, Dict[int, float]] = {}
+    with SqliteDict(filename, flag="r") as cache:
+        for key, value in cache.items():
+            match = key_re.match(key)
+            if match is None:
+                continue
+            symbol, date = match.groups()
+            offset = minute_offset(datetime.fromisoformat(date))
+            minutes.setdefault(symbol, {})[offset] = MISSING if value == "MISSING" else float(value)
+
+    # Write every run of consecutive minutes at once, the last run first so that each file is grown only once
+    for symbol, prices in minutes.items():
+        offsets = np.array(sorted(prices), dtype=np.int64)
+        runs = np.split(offsets, np.flatnonzero(np.diff(offsets) != 1) + 1)
+        for run in reversed(runs):
+            store.put(symbol, minute_datetime(int(run[0])), [prices[offset] for offset in run.tolist()])
+    store.flush()
+    return sum(len(prices) for prices in minutes.values())
+
+
+def import_kline_dump(store: KlineStore, symbol: str, filename: str):
+    """
+    Import a Binance kline dump, either a data.binance.vision CSV or a JSON list as returned by the API.
+
+    Minutes between the first and last kline that aren't in the dump are marked as missing.
+    """
+    with open(filename) as fh:
+        if filename.endswith(".json"):
+            klines = json.load(fh)
+        else:
+            klines = [row for row in csv.reader(fh) if row and row[0].isdigit()]
+
+    if not klines:
+        return 0
+
+    klines.sort(key=lambda kline: int(kline[0]))
+    first = datetime.utcfromtimestamp(int(klines[0][0]) / 1000).replace(second=0, microsecond=0)
+    last = datetime.utcfromtimestamp(int(klines[-1][0]) / 1000).replace(second=0, microsecond=0)
+    store.put(symbol, first, [None] * (minute_offset(last) - minute_offset(first) + 1))
+    store.put_klines(symbol, klines)
+    store.flush()
+    return len(klines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fill the backtesting kline store offline")
+    parser.add_argument("--path", default="data/klines", help="kline store directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    cache_parser = subparsers.add_parser("import-cache", help="import a SqliteDict backtest cache")
+    cache_parser.add_argument("filename", nargs="?", default="data/backtest_cache.db")
+
+    dump_parser = subparsers.add_parser("import-klines", help="import Binance kline CSV/JSON dumps")
+    dump_parser.add_argument("symbol")
+    dump_parser.add_argument("filenames", nargs="+")
+
+    args = parser.parse_args()
+    store = KlineStore(args.path)
+    if args.command == "import-cache":
+        print(f"Imported {import_sqlitedict_cache(store, args.filename)} prices")
+    else:
+        for filename in args.filenames:
+            print(f"Imported {import_kline_dump(store, args.symbol, filename)} klines from {filename}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 import enum
 from datetime import datetime as _datetime
+from typing import Optional
 
-from sqlalchemy import Column, DateTime, Enum, Float, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, Enum, Float, ForeignKey, Index, Integer, String
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 
@@ -15,9 +16,27 @@ class Interval(enum.Enum):
     DAILY = "DAILY"
     WEEKLY = "WEEKLY"
 
+    @staticmethod
+    def of(previous: Optional[_datetime], datetime: _datetime) -> "Interval":  # pylint: disable=unsubscriptable-object
+        """
+        Tier of a value following one written at `previous` in the same series: the first value of every week, day
+        and hour is kept for longer, see Database.prune_value_history
+        """
+        if previous is None or previous.strftime("%Y-%W") != datetime.strftime("%Y-%W"):
+            return Interval.WEEKLY
+        if previous.date() != datetime.date():
+            return Interval.DAILY
+        if previous.hour != datetime.hour:
+            return Interval.HOURLY
+        return Interval.MINUTELY
+
 
 class CoinValue(Base):
     __tablename__ = "coin_value"
+    __table_args__ = (
+        Index("ix_coin_value_coin_id_datetime_interval", "coin_id", "datetime", "interval"),
+        Index("ix_coin_value_interval_datetime", "interval", "datetime"),
+    )
 
     id = Column(Integer, primary_key=True)
 
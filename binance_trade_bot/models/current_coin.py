@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from sqlalchemy import Column, DateTime, ForeignKey, Integer, String
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, String
 from sqlalchemy.orm import relationship
 
 from .base import Base
@@ -9,6 +9,7 @@ from .coin import Coin
 
 class CurrentCoin(Base):  # pylint: disable=too-few-public-methods
     __tablename__ = "current_coin_history"
+    __table_args__ = (Index("ix_current_coin_history_datetime", "datetime"),)
     id = Column(Integer, primary_key=True)
     coin_id = Column(String, ForeignKey("coins.symbol"))
     coin = relationship("Coin")
@@ -0,0 +1,40 @@
+from datetime import datetime as _datetime
+
+from sqlalchemy import Column, DateTime, Enum, Float, Index, Integer
+
+from .base import Base
+from .coin_value import Interval
+
+
+class PortfolioValue(Base):  # pylint: disable=too-few-public-methods
+    """
+    Total value of the coin balances of a CoinValue snapshot, tiered the same way
+    """
+
+    __tablename__ = "portfolio_value"
+    __table_args__ = (
+        Index("ix_portfolio_value_datetime", "datetime"),
+        Index("ix_portfolio_value_interval_datetime", "interval", "datetime"),
+    )
+
+    id = Column(Integer, primary_key=True)
+
+    usd_value = Column(Float)
+    btc_value = Column(Float)
+
+    interval = Column(Enum(Interval, name="coin_interval"))
+
+    datetime = Column(DateTime)
+
+    def __init__(self, usd_value: float, btc_value: float, interval=Interval.MINUTELY, datetime: _datetime = None):
+        self.usd_value = usd_value
+        self.btc_value = btc_value
+        self.interval = interval
+        self.datetime = datetime or _datetime.now()
+
+    def info(self):
+        return {
+            "usd_value": self.usd_value,
+            "btc_value": self.btc_value,
+            "datetime": self.datetime.isoformat(),
+        }
@@ -0,0 +1,146 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from .binance_api_manager import BinanceAPIManager
+from .config import Config
+from .database import Database
+from .instrumentation import instrumentation, timed
+from .logger import Logger
+from .models import Coin, Pair
+
+
+class RatioEngine:
+    """
+    Keeps the target ratio of every enabled pair in a coin-indexed NumPy matrix, so the margin of every
+    from->to jump can be worked out with a handful of array operations instead of one Python call per pair.
+
+    The matrix is loaded lazily from the database and has to be invalidated whenever pair ratios change.
+    """
+
+    def __init__(self, binance_manager: BinanceAPIManager, database: Database, logger: Logger, config: Config):
+        self.manager = binance_manager
+        self.db = database
+        self.logger = logger
+        self.config = config
+
+        self.coins: List[Coin] = []
+        self.coin_index: Dict[str, int] = {}
+        # Symbol of every coin and of its bridge ticker, indexed like coins
+        self.symbols: Tuple[str, ...] = ()
+        self.ticker_symbols: Tuple[str, ...] = ()
+        self.pairs: Dict[Tuple[int, int], Pair] = {}
+        # ratios[i, j] is the target ratio of coins[i] -> coins[j], NaN when there is no usable pair
+        self.ratios = np.empty((0, 0))
+        self._stale = True
+
+    def invalidate(self):
+        """
+        Mark the cached ratios as outdated, they will be reloaded from the database on next use
+        """
+        self._stale = True
+
+    def refresh(self):
+        """
+        Reload coins, pairs and target ratios from the database if they were invalidated
+        """
+        if not self._stale:
+            return
+
+        self.coins = self.db.get_coins()
+        self.coin_index = {coin.symbol: i for i, coin in enumerate(self.coins)}
+        self.symbols = tuple(coin.symbol for coin in self.coins)
+        self.ticker_symbols = tuple(coin + self.config.BRIDGE for coin in self.coins)
+        self.pairs = {}
+        self.ratios = np.full((len(self.coins), len(self.coins)), np.nan)
+
+        for pair in self.db.get_pairs():
+            from_index = self.coin_index.get(pair.from_coin_id)
+            to_index = self.coin_index.get(pair.to_coin_id)
+            if from_index is None or to_index is None or pair.ratio is None:
+                continue
+            self.pairs[(from_index, to_index)] = pair
+            self.ratios[from_index, to_index] = pair.ratio
+
+        self._stale = False
+
+    def get_prices(self, indexes: np.ndarray) -> np.ndarray:
+        """
+        Get the bridge price of every coin at once, making sure the given coins have one unless they have no ticker.
+        NaN where there is no price.
+        """
+        return self.manager.get_ticker_price_vector(self.ticker_symbols, indexes)
+
+    def get_fees(self, indexes: np.ndarray, selling: bool) -> np.ndarray:
+        """
+        Get the fee of trading the given coins against the bridge, NaN for the coins whose fee isn't known yet.
+        The vector is shared with the fee model and must not be modified.
+        """
+        return self.manager.get_fee_vector(self.symbols, self.config.BRIDGE.symbol, selling, indexes)
+
+    def compute_margins(self, from_prices, to_prices, sell_fees, buy_fees, ratios):
+        """
+        Margin of jumping between coins at the given bridge prices, fees and target ratios. Works on scalars as
+        well as on any broadcastable arrays, and always performs the same floating point operations.
+        """
+        # Obtain (current coin)/(optional coin)
+        coin_opt_coin_ratio = from_prices / to_prices
+        transaction_fee = sell_fees + buy_fees
+        return (
+            coin_opt_coin_ratio - transaction_fee * self.config.SCOUT_MULTIPLIER * coin_opt_coin_ratio
+        ) - ratios
+
+    @timed()
+    def get_margins(self, coin: Coin, coin_price: float) -> Tuple[List[Pair], np.ndarray, np.ndarray]:
+        """
+        Given a coin, get the margin of jumping to every other enabled coin.
+
+        :return: the pairs that could be evaluated, their margins and their target ratios
+        """
+        self.refresh()
+
+        from_index = self.coin_index.get(coin.symbol)
+        if from_index is None:
+            return [], np.empty(0), np.empty(0)
+
+        to_indexes = np.flatnonzero(~np.isnan(self.ratios[from_index]))
+        prices = self.get_prices(to_indexes)
+
+        for to_index in to_indexes[np.isnan(prices[to_indexes])]:
+            self.logger.info(
+                "Skipping scouting... optional coin {} not found".format(self.coins[to_index] + self.config.BRIDGE)
+            )
+        to_indexes = to_indexes[~np.isnan(prices[to_indexes])]
+
+        pairs = [self.pairs[(from_index, to_index)] for to_index in to_indexes]
+        instrumentation.count("ratios_evaluated", len(pairs))
+        ratios = self.ratios[from_index, to_indexes]
+        self.db.log_scouts(pairs, ratios.tolist(), coin_price, prices[to_indexes].tolist())
+
+        if not pairs:
+            return pairs, np.empty(0), ratios
+
+        sell_fee = self.manager.get_fee(coin, self.config.BRIDGE, True)
+        buy_fees = self.get_fees(to_indexes, False)[to_indexes]
+
+        margins = self.compute_margins(coin_price, prices[to_indexes], sell_fee, buy_fees, ratios)
+        return pairs, margins, ratios
+
+    def get_margin_matrix(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Get the margin of every from->to jump between enabled coins at once.
+
+        :return: the bridge price of every coin and the margin matrix, NaN where a jump can't be evaluated
+        """
+        self.refresh()
+
+        prices = self.get_prices(np.arange(len(self.coins)))
+        indexes = np.flatnonzero(~np.isnan(prices))
+        sell_fees = self.get_fees(indexes, True)
+        buy_fees = self.get_fees(indexes, False)
+
+        with np.errstate(invalid="ignore"):
+            margins = self.compute_margins(
+                prices[:, None], prices[None, :], sell_fees[:, None], buy_fees[None, :], self.ratios
+            )
+        return prices, margins
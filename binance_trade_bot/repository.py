@@ -0,0 +1,58 @@
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from .models import Coin, CurrentCoin, Pair
+
+
+class Repository:
+    """
+    In-memory copy of the coins, pairs and current coin of the bot.
+
+    Everything is loaded in a single session so that pairs share the Coin instances of the repository. The
+    instances are detached, reads never touch the database and writes go to both (see Database).
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self.coins: Dict[str, Coin] = {}
+        self.pairs: Dict[Tuple[str, str], Pair] = {}
+        self.current_coin: Optional[Coin] = None
+        self.current_coin_date: Optional[datetime] = None
+
+    def load(self, session: Session):
+        self.coins = {coin.symbol: coin for coin in session.query(Coin).all()}
+        self.pairs = {(pair.from_coin_id, pair.to_coin_id): pair for pair in session.query(Pair).all()}
+
+        current_coin = session.query(CurrentCoin).order_by(CurrentCoin.datetime.desc()).first()
+        if current_coin is None:
+            self.current_coin = self.current_coin_date = None
+        else:
+            self.current_coin = self.coins[current_coin.coin_id]
+            self.current_coin_date = current_coin.datetime
+
+        session.expunge_all()
+        self.loaded = True
+
+    def get_coins(self, only_enabled=True) -> List[Coin]:
+        return [coin for coin in self.coins.values() if coin.enabled or not only_enabled]
+
+    def get_coin(self, symbol: str) -> Optional[Coin]:
+        return self.coins.get(symbol)
+
+    def set_current_coin(self, symbol: str, date: datetime):
+        self.current_coin = self.coins[symbol]
+        self.current_coin_date = date
+
+    def get_pair(self, from_symbol: str, to_symbol: str) -> Optional[Pair]:
+        return self.pairs.get((from_symbol, to_symbol))
+
+    def get_pairs(self, only_enabled=True, from_symbol: str = None, to_symbol: str = None) -> List[Pair]:
+        return [
+            pair
+            for (pair_from, pair_to), pair in self.pairs.items()
+            if (from_symbol is None or pair_from == from_symbol)
+            and (to_symbol is None or pair_to == to_symbol)
+            and (pair.enabled or not only_enabled)
+        ]
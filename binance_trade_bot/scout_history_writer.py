@@ -0,0 +1,161 @@
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import TYPE_CHECKING, Deque, List, Tuple
+
+from sqlalchemy.orm import Session
+
+from .instrumentation import instrumentation
+from .logger import Logger
+from .models import Pair, ScoutHistory
+
+if TYPE_CHECKING:
+    from .database import Database
+
+# Pair, target ratio, current coin price, other coin price and datetime of a scout history row
+ScoutRow = Tuple[Pair, float, float, float, datetime]
+
+
+class ScoutHistoryWriter:
+    """
+    Writes scout history rows from a background thread, so scouting never waits on the database.
+
+    Rows are queued in memory and inserted in one batch per flush interval. When the database can't keep up
+    and the queue is full, the oldest rows are dropped.
+
+    With a `ring_size`, the table is used as a ring buffer of that many rows: ids 1 to ring_size are reused in
+    turn, each batch replacing the oldest rows, so the table never grows and never needs pruning.
+    """
+
+    def __init__(
+        self, db: "Database", logger: Logger, max_queue=10000, flush_interval=1.0, batch_size=1000, ring_size=0
+    ):
+        self.db = db
+        self.logger = logger
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.ring_size = ring_size
+        # Index of the ring slot written next, found from the table on the first write
+        self._next_slot = None
+
+        self.queue: Deque[ScoutRow] = deque(maxlen=max_queue)
+        self.condition = threading.Condition()
+        self.closed = False
+
+        self.dropped = 0
+        self._reported_dropped = 0
+        self.written = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+        self.thread = threading.Thread(target=self._run, name="scout-history-writer", daemon=True)
+        self.thread.start()
+
+    def put_many(self, scouts: List[ScoutRow]):
+        with self.condition:
+            self.dropped += max(len(self.queue) + len(scouts) - self.queue.maxlen, 0)
+            self.queue.extend(scouts)
+            if len(self.queue) >= self.batch_size:
+                self.condition.notify()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self.queue)
+
+    def stats(self):
+        return {
+            "queue_depth": self.queue_depth,
+            "dropped": self.dropped,
+            "written": self.written,
+            "last_flush_latency": self.last_flush_latency,
+            "max_flush_latency": self.max_flush_latency,
+        }
+
+    def _take(self) -> List[ScoutRow]:
+        with self.condition:
+            return [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+
+    def _assign_slots(self, session: Session, rows: List[dict]) -> int:
+        """
+        Give the rows the ids of the oldest slots of the ring, and return the slot following them
+        """
+        next_slot = self._next_slot
+        if next_slot is None:
+            last = session.query(ScoutHistory.id).order_by(ScoutHistory.datetime.desc(), ScoutHistory.id.desc()).first()
+            next_slot = last.id % self.ring_size if last is not None and last.id <= self.ring_size else 0
+        for row in rows:
+            row["id"] = next_slot + 1
+            next_slot = (next_slot + 1) % self.ring_size
+        return next_slot
+
+    def _write(self, scouts: List[ScoutRow]):
+        start = time.monotonic()
+        if self.ring_size:
+            scouts = scouts[-self.ring_size :]
+        rows = [
+            {
+                "pair_id": pair.id,
+                "target_ratio": target_ratio,
+                "current_coin_price": current_coin_price,
+                "other_coin_price": other_coin_price,
+                "datetime": scout_datetime,
+            }
+            for pair, target_ratio, current_coin_price, other_coin_price, scout_datetime in scouts
+        ]
+        next_slot = None
+        session: Session
+        with self.db.db_session() as session:
+            if self.ring_size:
+                next_slot = self._assign_slots(session, rows)
+                slots = [row["id"] for row in rows]
+                session.execute(ScoutHistory.__table__.delete().where(ScoutHistory.id.in_(slots)))
+            session.execute(ScoutHistory.__table__.insert(), rows)
+        # Only once committed, so that a failed write doesn't skip slots
+        self._next_slot = next_slot
+        self.last_flush_latency = time.monotonic() - start
+        self.max_flush_latency = max(self.max_flush_latency, self.last_flush_latency)
+        self.written += len(rows)
+        instrumentation.record("ScoutHistoryWriter.write", self.last_flush_latency)
+        instrumentation.count("scout_history_written", len(rows))
+
+        if self.db.socketio_connect():
+            for pair, target_ratio, current_coin_price, other_coin_price, scout_datetime in scouts:
+                scout = ScoutHistory(pair, target_ratio, current_coin_price, other_coin_price)
+                scout.datetime = scout_datetime
+                self.db.send_update(scout)
+
+    def flush(self):
+        """
+        Write everything that is queued right now
+        """
+        scouts = self._take()
+        while scouts:
+            try:
+                self._write(scouts)
+            except Exception as e:  # pylint: disable=broad-except
+                self.logger.error(f"Failed to write {len(scouts)} scout history rows: {e}")
+            scouts = self._take()
+        dropped = self.dropped
+        if dropped > self._reported_dropped:
+            self.logger.warning(f"Scout history queue is full, dropped {dropped - self._reported_dropped} oldest rows")
+            self._reported_dropped = dropped
+
+    def _run(self):
+        while True:
+            with self.condition:
+                if not self.closed and len(self.queue) < self.batch_size:
+                    self.condition.wait(self.flush_interval)
+                closed = self.closed
+            self.flush()
+            if closed:
+                return
+
+    def close(self):
+        """
+        Stop the writer thread once everything queued has been written
+        """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
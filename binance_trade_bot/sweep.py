@@ -0,0 +1,247 @@
+import argparse
+import itertools
+import logging
+import os
+import random
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from .backtest import MockBinanceManager, backtest
+from .config import Config
+from .kline_prefetcher import KlinePrefetcher, binance_client_factory
+from .kline_store import KlineStore
+from .logger import Logger
+from .models import Coin
+
+# Config attributes that can be swept over
+SWEEP_PARAMETERS = ("SCOUT_MULTIPLIER", "MAX_LOSS_PERCENT", "LOSS_AFTER_HOURS", "STRATEGY", "SUPPORTED_COIN_LIST")
+
+
+def _make_config(params: Dict[str, Any]) -> Config:
+    config = Config()
+    for name, value in params.items():
+        setattr(config, name, value)
+    # Every run gets its own in-memory database
+    config.DB_URI = "sqlite://"
+    return config
+
+
+def _bridge_value(manager: MockBinanceManager, last_prices: Dict[str, float]):
+    """
+    Value of all balances in the bridge coin, using the last known price of coins that have no price right now.
+    None if a coin never had a price yet.
+    """
+    bridge = manager.config.BRIDGE.symbol
+    total = 0
+    for coin, balance in manager.balances.items():
+        if coin == bridge:
+            total += balance
+            continue
+        price = manager.get_ticker_price(coin + bridge)
+        if price is None:
+            price = last_prices.get(coin)
+            if price is None:
+                return None
+        last_prices[coin] = price
+        total += price * balance
+    return total
+
+
+def _run_backtest(params: Dict[str, Any], start_date: datetime, end_date: datetime, interval, sample_interval):
+    """
+    Run one backtest in a worker process and summarize it
+    """
+    config = _make_config(params)
+    logger = Logger(config, "backtesting", enable_notifications=False)
+    logger.logger.setLevel(logging.WARNING)
+
+    # Prices were prefetched by the parent process, all workers map the same files read-only
+    kline_store = KlineStore("data/klines", readonly=True)
+
+    with open(os.devnull, "w") as devnull:
+        stdout, sys.stdout = sys.stdout, devnull
+        try:
+            peak = max_drawdown = 0
+            last_prices: Dict[str, float] = {}
+            manager = None
+            for manager in backtest(
+                start_date,
+                end_date,
+                interval=interval,
+                yield_interval=sample_interval,
+                config=config,
+                logger=logger,
+                event_driven=config.STRATEGY == "default",
+                kline_store=kline_store,
+            ):
+                value = _bridge_value(manager, last_prices)
+                if value is None:
+                    continue
+                peak = max(peak, value)
+                if peak > 0:
+                    max_drawdown = max(max_drawdown, (peak - value) / peak)
+        finally:
+            sys.stdout = stdout
+
+    if manager is None:
+        # backtest() returns before its first step for an unknown strategy or an empty date range
+        raise ValueError(f"Backtest with {_format_params(params)} didn't run, check the strategy and the dates")
+
+    bridge_value = _bridge_value(manager, last_prices)
+    btc_price = manager.get_ticker_price("BTC" + config.BRIDGE.symbol)
+    return {
+        "params": params,
+        "bridge_value": bridge_value or 0,
+        "btc_value": bridge_value / btc_price if bridge_value is not None and btc_price else None,
+        "trades": manager.trade_count,
+        "max_drawdown": max_drawdown * 100,
+    }
+
+
+def search_space(grid: Dict[str, List[Any]], samples: int = None, seed: int = None) -> List[Dict[str, Any]]:
+    """
+    Every combination of the grid values, or `samples` random ones among them
+    """
+    names = list(grid)
+    combinations = list(itertools.product(*(grid[name] for name in names)))
+    if samples is not None and samples < len(combinations):
+        combinations = random.Random(seed).sample(combinations, samples)
+    return [dict(zip(names, combination)) for combination in combinations]
+
+
+def prefetch(space: List[Dict[str, Any]], start_date: datetime, end_date: datetime, logger: Logger):
+    """
+    Fetch the prices every run of the search space needs, so workers never have to write to the kline store
+    """
+    config = _make_config({})
+    bridge = config.BRIDGE.symbol
+    symbols = {"BTC" + bridge}
+    for params in space:
+        for coin in params.get("SUPPORTED_COIN_LIST", config.SUPPORTED_COIN_LIST):
+            symbols.add(coin + bridge)
+
+    store = KlineStore("data/klines")
+    try:
+        # A scout may still run at end_date
+        KlinePrefetcher(store, binance_client_factory(config), logger).prefetch(
+            sorted(symbols), start_date, end_date + timedelta(minutes=1)
+        )
+    finally:
+        store.close()
+
+
+def sweep(
+    grid: Dict[str, List[Any]],
+    start_date: datetime,
+    end_date: datetime,
+    samples: int = None,
+    seed: int = None,
+    processes: int = None,
+    interval=1,
+    sample_interval=60,
+    logger: Logger = None,
+):
+    """
+    Backtest every configuration of a search space in a process pool.
+
+    :param grid: Values to try for each of the SWEEP_PARAMETERS config attributes
+    :param start_date: Date to backtest from
+    :param end_date: Date to backtest up to
+    :param samples: Number of random configurations to try. Default: all of them
+    :param seed: Seed of the random search
+    :param processes: Number of worker processes. Default: number of CPUs
+    :param interval: Number of virtual minutes between each scout
+    :param sample_interval: Number of intervals between the samples used to compute drawdowns
+
+    :return: The summary of every run, best bridge value first
+    """
+    for name in grid:
+        if name not in SWEEP_PARAMETERS:
+            raise ValueError(f"Can't sweep over {name}, choose from {', '.join(SWEEP_PARAMETERS)}")
+
+    logger = logger or Logger(Config(), "sweep", enable_notifications=False)
+    space = search_space(grid, samples, seed)
+    prefetch(space, start_date, end_date, logger)
+
+    results = []
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = {
+            executor.submit(_run_backtest, params, start_date, end_date, interval, sample_interval): params
+            for params in space
+        }
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:  # pylint: disable=broad-except
+                logger.error(f"Backtest with {futures[future]} failed: {e}")
+                continue
+            logger.info(f"Finished {len(results) + 1}/{len(space)}: {result}")
+            results.append(result)
+
+    results.sort(key=lambda result: result["bridge_value"], reverse=True)
+    return results
+
+
+def _format_params(params: Dict[str, Any]):
+    return ", ".join(
+        f"{name}={' '.join(value) if isinstance(value, list) else value}" for name, value in params.items()
+    )
+
+
+def format_results(results: List[Dict[str, Any]], bridge: Coin) -> str:
+    header = " | ".join(
+        [f"{'#':>3}", f"{bridge.symbol:>12}", f"{'BTC':>12}", f"{'Trades':>6}", f"{'MaxDD%':>7}", "Config"]
+    )
+    rows = [
+        " | ".join(
+            [
+                f"{rank:>3}",
+                f"{result['bridge_value']:>12.4f}",
+                f"{result['btc_value']:>12.8f}" if result["btc_value"] is not None else f"{'--':>12}",
+                f"{result['trades']:>6}",
+                f"{result['max_drawdown']:>7.2f}",
+                _format_params(result["params"]),
+            ]
+        )
+        for rank, result in enumerate(results, 1)
+    ]
+    return "\n".join([header, "-" * len(header), *rows])
+
+
+def _parse_param(config: Config, param: str):
+    name, _, values = param.partition("=")
+    if name not in SWEEP_PARAMETERS:
+        raise argparse.ArgumentTypeError(f"Can't sweep over {name}, choose from {', '.join(SWEEP_PARAMETERS)}")
+    current = getattr(config, name)
+    if isinstance(current, list):
+        return name, [value.split() for value in values.split(",")]
+    return name, [type(current)(value) for value in values.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Backtest a grid of configurations in parallel")
+    parser.add_argument("--start", type=datetime.fromisoformat, default=datetime(2021, 1, 1))
+    parser.add_argument("--end", type=datetime.fromisoformat, default=datetime.today())
+    parser.add_argument(
+        "--param",
+        action="append",
+        default=[],
+        metavar="NAME=VALUE,VALUE",
+        help="config values to try, coin lists are space separated (SUPPORTED_COIN_LIST='XLM TRX,ADA EOS')",
+    )
+    parser.add_argument("--samples", type=int, help="number of random configurations to try instead of all")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--processes", type=int)
+    parser.add_argument("--interval", type=int, default=1)
+    args = parser.parse_args()
+
+    config = Config()
+    grid = dict(_parse_param(config, param) for param in args.param)
+    results = sweep(grid, args.start, args.end, args.samples, args.seed, args.processes, args.interval)
+    print(format_results(results, config.BRIDGE))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import json
+import os
+import threading
+import time
+from typing import Dict, NamedTuple, Optional
+
+from binance.client import Client
+
+from .logger import Logger
+
+# How long the filters are trusted before being loaded again
+SYMBOL_FILTERS_TTL = 12 * 60 * 60
+# Don't hit the exchange info endpoint more often than this when asked for a symbol we don't know
+MISSING_SYMBOL_REFRESH_INTERVAL = 60
+
+
+def step_precision(step_size: str) -> int:
+    """
+    Number of decimals allowed by a step size such as "0.00100000", negative for steps above 1
+    """
+    if step_size.find("1") == 0:
+        return 1 - step_size.find(".")
+    return step_size.find("1") - 1
+
+
+class SymbolFilters(NamedTuple):
+    step_size: str
+    tick_size: str
+    min_notional: float
+    alt_tick: int
+
+
+def parse_symbol_filters(symbol_info: dict) -> SymbolFilters:
+    filters = {_filter["filterType"]: _filter for _filter in symbol_info["filters"]}
+    step_size = filters.get("LOT_SIZE", {}).get("stepSize", "1")
+    tick_size = filters.get("PRICE_FILTER", {}).get("tickSize", "1")
+    min_notional = float((filters.get("MIN_NOTIONAL") or filters.get("NOTIONAL") or {}).get("minNotional", 0))
+    return SymbolFilters(step_size, tick_size, min_notional, step_precision(step_size))
+
+
+class SymbolFilterTable:
+    """
+    Trading filters of every symbol of the exchange, loaded with a single exchange info request.
+
+    The raw filters are saved to `path`, so that a restart can use them right away and refresh them in the
+    background when they're older than `ttl`.
+    """
+
+    def __init__(self, client: Client, logger: Logger, path: str, ttl=SYMBOL_FILTERS_TTL):
+        self.client = client
+        self.logger = logger
+        self.path = path
+        self.ttl = ttl
+        # Replaced as a whole on refresh, never modified
+        self.symbols: Dict[str, SymbolFilters] = {}
+        self.updated = 0.0
+        # When a refresh was last started for a symbol we didn't know
+        self._missing_refresh = 0.0
+        self._refresh_mutex = threading.Lock()
+
+    def load(self):
+        """
+        Load the saved filters if there are any, or fetch them
+        """
+        try:
+            with open(self.path) as fh:
+                saved = json.load(fh)
+            self.symbols = {symbol: SymbolFilters(*filters) for symbol, filters in saved["symbols"].items()}
+            self.updated = saved["updated"]
+            self.logger.debug(f"Loaded the filters of {len(self.symbols)} symbols from {self.path}")
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            self.logger.debug(f"No usable symbol filters in {self.path} ({e}), fetching them")
+            self.refresh()
+            return
+        if self.is_stale():
+            self.refresh_in_background()
+
+    def is_stale(self) -> bool:
+        return time.time() - self.updated > self.ttl
+
+    def refresh(self):
+        with self._refresh_mutex:
+            symbols = {
+                symbol_info["symbol"]: parse_symbol_filters(symbol_info)
+                for symbol_info in self.client.get_exchange_info()["symbols"]
+            }
+            self.symbols, self.updated = symbols, time.time()
+            self._save()
+
+    def refresh_in_background(self):
+        threading.Thread(target=self._safe_refresh, name="symbol-filters", daemon=True).start()
+
+    def _safe_refresh(self):
+        try:
+            self.refresh()
+        except Exception as e:  # pylint: disable=broad-except
+            self.logger.warning(f"Couldn't refresh the symbol filters, keeping the previous ones: {e}")
+
+    def _save(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump({"updated": self.updated, "symbols": self.symbols}, fh)
+        os.replace(tmp_path, self.path)
+
+    def get(self, symbol: str) -> Optional[SymbolFilters]:  # pylint: disable=unsubscriptable-object
+        """
+        Filters of a symbol, None if it isn't known (yet)
+        """
+        filters = self.symbols.get(symbol)
+        now = time.time()
+        if filters is None and now - max(self.updated, self._missing_refresh) > MISSING_SYMBOL_REFRESH_INTERVAL:
+            # Might have been listed since the last refresh, look for it without holding up the order
+            self._missing_refresh = now
+            self.refresh_in_background()
+        return filters
@@ -0,0 +1,99 @@
+"""
+Benchmark of the market data ingestion path: decoding miniTicker messages into the ticker cache, the latency from
+the websocket callback to the cache, and the CPU used while the streams are idle.
+
+Run with `python -m tests.bench_stream_ingestion`, no network access is needed.
+"""
+import json
+import statistics
+import threading
+import time
+from types import SimpleNamespace
+
+from binance_trade_bot.binance_stream_manager import STREAM_TICKERS, BinanceCache, BinanceStreamManager
+
+# About as many tickers as Binance sends in every !miniTicker@arr message
+TICKERS = 1500
+WATCHED = 15
+
+
+def make_message(event_time_ms: int) -> str:
+    tickers = [
+        {
+            "e": "24hrMiniTicker",
+            "E": event_time_ms,
+            "s": f"COIN{i}USDT",
+            "c": f"{1 + i / 1000:.8f}",
+            "o": "1.00000000",
+            "h": "2.00000000",
+            "l": "0.50000000",
+            "v": "123456.78000000",
+            "q": "234567.89000000",
+        }
+        for i in range(TICKERS)
+    ]
+    return json.dumps({"stream": "!miniTicker@arr", "data": tickers}, separators=(",", ":"))
+
+
+def bench_decoding(manager: BinanceStreamManager, message: str, runs=200):
+    start = time.perf_counter()
+    for _ in range(runs):
+        manager._process_tickers(message)  # pylint: disable=protected-access
+    return (time.perf_counter() - start) / runs * 1000
+
+
+def bench_latency(manager: BinanceStreamManager, message: str, runs=300):
+    cache = manager.cache
+    updated = threading.Event()
+    update = cache.update_ticker_values
+
+    def update_and_signal(values):
+        result = update(values)
+        updated.set()
+        return result
+
+    cache.update_ticker_values = update_and_signal
+    latencies = []
+    for _ in range(runs):
+        updated.clear()
+        start = time.perf_counter()
+        manager.bw_api_manager.process_stream_data(message, stream_buffer_name=STREAM_TICKERS)
+        updated.wait()
+        latencies.append((time.perf_counter() - start) * 1000)
+        time.sleep(0.005)
+    cache.update_ticker_values = update
+    latencies.sort()
+    return statistics.median(latencies), latencies[int(len(latencies) * 0.99) - 1]
+
+
+def bench_idle_cpu(seconds=5):
+    start_cpu, start = time.process_time(), time.perf_counter()
+    time.sleep(seconds)
+    return (time.process_time() - start_cpu) / (time.perf_counter() - start) * 100
+
+
+def main():
+    config = SimpleNamespace(BINANCE_TLD="com", BINANCE_API_KEY="", BINANCE_API_SECRET_KEY="")
+    logger = SimpleNamespace(debug=print, info=print, warning=print, error=print)
+    manager = BinanceStreamManager(BinanceCache(), config, None, logger, streams=())
+    try:
+        message = make_message(int(time.time() * 1000))
+        print(f"{TICKERS} tickers per message, {len(message) // 1024} KiB")
+        loads_only = SimpleNamespace(_process_tickers=json.loads)
+        print(f"json.loads alone: {bench_decoding(loads_only, message):.2f} ms/message")
+        print(f"decode, nothing watched: {bench_decoding(manager, message):.2f} ms/message")
+        manager.cache.tickers.watch("bench", [f"COIN{i * 97}USDT" for i in range(WATCHED)])
+        print(f"decode, {WATCHED} watched: {bench_decoding(manager, message):.2f} ms/message")
+        median, p99 = bench_latency(manager, message)
+        print(f"callback to cache latency: median {median:.3f} ms, p99 {p99:.3f} ms")
+        print(f"idle process CPU, websocket manager threads included: {bench_idle_cpu():.2f}%")
+        assert len(manager.cache.ticker_values) == WATCHED
+    finally:
+        manager.close()
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join(10)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from binance_trade_bot.binance_stream_manager import STREAM_TICKERS, BinanceCache, BinanceStreamManager
+
+# A message of the !miniTicker@arr combined stream, as sent by Binance
+COMBINED_FRAME = json.dumps(
+    {
+        "stream": "!miniTicker@arr",
+        "data": [
+            {
+                "e": "24hrMiniTicker",
+                "E": 1620000000000,
+                "s": "BTCUSDT",
+                "c": "57000.10",
+                "o": "56000.00",
+                "h": "58000.00",
+                "l": "55000.00",
+                "v": "1000.0",
+                "q": "57000000.0",
+            },
+            {
+                "e": "24hrMiniTicker",
+                "E": 1620000000000,
+                "s": "ETHBTC",
+                "c": "0.06100",
+                "o": "0.06000",
+                "h": "0.06200",
+                "l": "0.05900",
+                "v": "2000.0",
+                "q": "122.0",
+            },
+        ],
+    },
+    separators=(",", ":"),
+)
+
+
+# The websocket manager's threads end with sys.exit()
+pytestmark = pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+
+
+@pytest.fixture
+def stream_manager():
+    threads = set(threading.enumerate())
+    config = SimpleNamespace(BINANCE_TLD="com", BINANCE_API_KEY="", BINANCE_API_SECRET_KEY="")
+    manager = BinanceStreamManager(BinanceCache(), config, None, SimpleNamespace(), streams=())
+    yield manager
+    manager.close()
+    for thread in set(threading.enumerate()) - threads:
+        thread.join(10)
+
+
+def wait_for_version(cache: BinanceCache, version: int, timeout=5):
+    deadline = time.monotonic() + timeout
+    while cache.ticker_version <= version:
+        assert time.monotonic() < deadline, "the ticker snapshot wasn't updated"
+        time.sleep(0.01)
+
+
+def test_combined_stream_frame_updates_snapshot(stream_manager):
+    cache = stream_manager.cache
+    version = cache.ticker_version
+    stream_manager.bw_api_manager.process_stream_data(COMBINED_FRAME, stream_buffer_name=STREAM_TICKERS)
+    wait_for_version(cache, version)
+    assert dict(cache.ticker_values) == {"BTCUSDT": 57000.10, "ETHBTC": 0.061}
+
+
+def test_combined_stream_frame_keeps_watched_tickers(stream_manager):
+    cache = stream_manager.cache
+    cache.tickers.watch("bot", ["ETHBTC"])
+    version = cache.ticker_version
+    stream_manager.bw_api_manager.process_stream_data(COMBINED_FRAME, stream_buffer_name=STREAM_TICKERS)
+    wait_for_version(cache, version)
+    assert dict(cache.ticker_values) == {"ETHBTC": 0.061}
+
+
+def test_subscription_results_are_ignored(stream_manager):
+    cache = stream_manager.cache
+    version = cache.ticker_version
+    stream_manager.bw_api_manager.process_stream_data('{"result":null,"id":1}', stream_buffer_name=STREAM_TICKERS)
+    stream_manager.bw_api_manager.process_stream_data(COMBINED_FRAME, stream_buffer_name=STREAM_TICKERS)
+    wait_for_version(cache, version)
+    assert cache.ticker_version == version + 1
+
+
+def test_frames_laid_out_differently_are_decoded(stream_manager):
+    cache = stream_manager.cache
+    version = cache.ticker_version
+    frame = json.dumps(json.loads(COMBINED_FRAME), indent=2, sort_keys=True)
+    stream_manager.bw_api_manager.process_stream_data(frame, stream_buffer_name=STREAM_TICKERS)
+    wait_for_version(cache, version)
+    assert dict(cache.ticker_values) == {"BTCUSDT": 57000.10, "ETHBTC": 0.061}
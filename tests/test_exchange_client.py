@@ -0,0 +1,95 @@
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from binance_trade_bot.exchange_client import USED_WEIGHT_HEADER, ExchangeClient
+
+TICKERS = [{"symbol": "BTCUSDT", "price": "57000.10"}, {"symbol": "ETHBTC", "price": "0.06100"}]
+
+
+class StubExchange(BaseHTTPRequestHandler):
+    """
+    Answers the public endpoints the client needs, reporting a fixed used weight like Binance does
+    """
+
+    used_weight = 600
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        path = self.path.split("?", 1)[0]
+        self.server.paths.append(path)
+        # Binance serves endpoints under several API versions
+        if path.endswith("/ping"):
+            body = {}
+        elif path.endswith("/time"):
+            body = {"serverTime": int(time.time() * 1000)}
+        elif path.endswith("/ticker/price"):
+            body = TICKERS
+        elif path.endswith("/order"):
+            # Slow enough that fetching orders one at a time would show
+            time.sleep(0.2)
+            body = {"symbol": "ETHBTC", "orderId": int(re.search(r"orderId=(\d+)", self.path).group(1))}
+        else:
+            self.send_error(404)
+            return
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header(USED_WEIGHT_HEADER, str(self.used_weight))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.fixture
+def exchange():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubExchange)
+    server.paths = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(exchange):
+    client = ExchangeClient("key", "secret", base_url=f"http://127.0.0.1:{exchange.server_port}")
+    yield client
+    client.close()
+
+
+def test_requests_go_to_base_url(exchange, client):
+    del exchange.paths[:]
+    assert client.get_all_tickers() == TICKERS
+    assert [path.rsplit("/", 1)[-1] for path in exchange.paths] == ["price"]
+    assert all(path.startswith("/api/") for path in exchange.paths)
+
+
+def test_used_weight_is_accounted(client):
+    client.get_all_tickers()
+    assert client.limiter.tokens <= client.limiter.capacity - StubExchange.used_weight
+
+
+def test_submitted_requests_run_concurrently(client):
+    # get_order is signed, the stub doesn't check signatures
+    start = time.monotonic()
+    futures = [client.submit(client.get_order, symbol="ETHBTC", orderId=order_id) for order_id in range(4)]
+    assert sorted(future.result()["orderId"] for future in futures) == [0, 1, 2, 3]
+    assert time.monotonic() - start < 0.6
+
+
+def test_close_stops_worker_threads(exchange):
+    client = ExchangeClient("key", "secret", base_url=f"http://127.0.0.1:{exchange.server_port}")
+    client.submit(client.get_all_tickers).result()
+    client.close()
+    for thread in threading.enumerate():
+        if thread.name.startswith("binance-rest"):
+            thread.join(5)
+    assert not [thread for thread in threading.enumerate() if thread.name.startswith("binance-rest")]
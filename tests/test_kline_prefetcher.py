@@ -0,0 +1,136 @@
+import json
+import threading
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from binance_trade_bot.exchange_client import ExchangeClient
+from binance_trade_bot.kline_prefetcher import KlinePrefetcher, _timestamp_ms
+from binance_trade_bot.kline_store import KlineStore
+
+START = datetime(2021, 1, 1)
+MINUTES = 2500
+# Binance has no klines for these minutes of ETHBTC
+GAP = range(1200, 1300)
+
+
+def kline(minute: int, price: float):
+    open_ms = _timestamp_ms(START + timedelta(minutes=minute))
+    return [open_ms, str(price), str(price), str(price), str(price), "1.0", open_ms + 59999, "1.0", 1, "1", "1", "0"]
+
+
+KLINES = {"ETHBTC": [kline(minute, 0.05 + minute / 1e6) for minute in range(MINUTES) if minute not in GAP]}
+
+
+class StubKlineServer(BaseHTTPRequestHandler):
+    """
+    Serves the canned klines like Binance does, failing the requests listed in `server.failures` first
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        if url.path.endswith("/klines"):
+            key = (params["symbol"], int(params["startTime"]))
+            self.server.requests.append(key)
+            if self.server.failures.get(key, 0) > 0:
+                self.server.failures[key] -= 1
+                self._reply(500, {"code": -1000, "msg": "An unknown error occurred"})
+            elif params["symbol"] not in KLINES:
+                self._reply(400, {"code": -1121, "msg": "Invalid symbol."})
+            else:
+                start, end = int(params["startTime"]), int(params["endTime"])
+                klines = [k for k in KLINES[params["symbol"]] if start <= k[0] <= end]
+                self._reply(200, klines[: int(params["limit"])])
+        elif url.path.endswith("/time"):
+            self._reply(200, {"serverTime": _timestamp_ms(datetime.utcnow())})
+        else:
+            self._reply(200, {})
+
+    def _reply(self, status: int, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubKlineServer)
+    server.requests = []
+    server.failures = {}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = KlineStore(str(tmp_path / "klines"))
+    yield store
+    store.close()
+
+
+def make_prefetcher(server, store, **kwargs):
+    base_url = f"http://127.0.0.1:{server.server_port}"
+    logger = SimpleNamespace(info=lambda *args: None, warning=lambda *args: None, error=lambda *args: None)
+    return KlinePrefetcher(store, lambda: ExchangeClient("key", "secret", base_url=base_url), logger, **kwargs)
+
+
+def test_prefetch_pages_and_marks_gaps(server, store):
+    prefetcher = make_prefetcher(server, store)
+    assert prefetcher.prefetch(["ETHBTC"], START, START + timedelta(minutes=MINUTES)) == 0
+
+    # One request per window of 1000 minutes
+    assert sorted(start for _, start in server.requests) == [
+        _timestamp_ms(START + timedelta(minutes=minute)) for minute in (0, 1000, 2000)
+    ]
+    assert store.get("ETHBTC", START) == pytest.approx(0.05)
+    assert store.get("ETHBTC", START + timedelta(minutes=2499)) == pytest.approx(0.05 + 2499 / 1e6)
+    for minute in (GAP.start, GAP.stop - 1):
+        assert store.get("ETHBTC", START + timedelta(minutes=minute)) is None
+    with pytest.raises(KeyError):
+        store.get("ETHBTC", START + timedelta(minutes=MINUTES))
+
+
+def test_prefetch_resumes_from_missing_windows(server, store):
+    prefetcher = make_prefetcher(server, store)
+    prefetcher.prefetch(["ETHBTC"], START, START + timedelta(minutes=1500))
+    del server.requests[:]
+
+    prefetcher.prefetch(["ETHBTC"], START, START + timedelta(minutes=MINUTES))
+    # Only the minutes after the first run, in one window
+    assert server.requests == [("ETHBTC", _timestamp_ms(START + timedelta(minutes=1500)))]
+    assert store.get("ETHBTC", START + timedelta(minutes=2499)) == pytest.approx(0.05 + 2499 / 1e6)
+
+
+def test_prefetch_retries_failed_requests(server, store):
+    server.failures[("ETHBTC", _timestamp_ms(START))] = 1
+    prefetcher = make_prefetcher(server, store)
+    assert prefetcher.prefetch(["ETHBTC"], START, START + timedelta(minutes=1000)) == 0
+    assert server.requests.count(("ETHBTC", _timestamp_ms(START))) == 2
+    assert store.get("ETHBTC", START) == pytest.approx(0.05)
+
+
+def test_prefetch_gives_up_after_retries(server, store):
+    server.failures[("ETHBTC", _timestamp_ms(START))] = 2
+    prefetcher = make_prefetcher(server, store, retries=2)
+    assert prefetcher.prefetch(["ETHBTC"], START, START + timedelta(minutes=1000)) == 1
+    # Left unfetched, so that the next run tries again
+    with pytest.raises(KeyError):
+        store.get("ETHBTC", START)
+
+
+def test_prefetch_marks_invalid_symbols_missing(server, store):
+    prefetcher = make_prefetcher(server, store)
+    assert prefetcher.prefetch(["NOPEBTC"], START, START + timedelta(minutes=10)) == 0
+    assert store.get("NOPEBTC", START) is None
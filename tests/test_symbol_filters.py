@@ -0,0 +1,49 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from binance_trade_bot.symbol_filters import SymbolFilterTable
+
+ETHBTC = {
+    "symbol": "ETHBTC",
+    "filters": [
+        {"filterType": "PRICE_FILTER", "tickSize": "0.00000100"},
+        {"filterType": "LOT_SIZE", "stepSize": "0.00100000"},
+        {"filterType": "MIN_NOTIONAL", "minNotional": "0.00010000"},
+    ],
+}
+
+
+class SlowClient:
+    def __init__(self):
+        self.symbols = []
+        self.calls = 0
+        self.release = threading.Event()
+
+    def get_exchange_info(self):
+        self.calls += 1
+        self.release.wait(5)
+        return {"symbols": self.symbols}
+
+
+def test_unknown_symbol_is_refreshed_in_background(tmp_path):
+    client = SlowClient()
+    logger = SimpleNamespace(debug=lambda *args: None, warning=lambda *args: None)
+    table = SymbolFilterTable(client, logger, str(tmp_path / "exchange_info.json"))
+    table.updated = time.time() - 3600
+
+    # Listed since the table was loaded
+    client.symbols = [ETHBTC]
+    start = time.monotonic()
+    assert table.get("ETHBTC") is None
+    assert table.get("ETHBTC") is None
+    assert time.monotonic() - start < 1
+    assert client.calls <= 1
+
+    client.release.set()
+    deadline = time.monotonic() + 5
+    while table.get("ETHBTC") is None:
+        assert time.monotonic() < deadline, "the symbol filters weren't refreshed"
+        time.sleep(0.01)
+    assert table.get("ETHBTC").alt_tick == 3
+    assert client.calls == 1